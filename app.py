@@ -1,5 +1,6 @@
 from shiny import App, ui
 from server import *
+from cache_refresher import start_cache_refresher
 
 
 def ui_card(title, *args):
@@ -35,7 +36,7 @@ crossref_page = ui.page_fluid(
     ui.panel_well(
         ui.h3("Upload a ", ui.tags.u("DOI"), " file:"),
         ui.input_file("crossref_user_file", "Choose a file to upload:", multiple=False),
-        ui.input_radio_buttons("crossref_type", "Type:", ["Text", "Other"]),
+        ui.input_radio_buttons("crossref_type", "Type:", ["Text", "Bibliographic export"]),
     ),
 
     ui.panel_well(
@@ -105,6 +106,16 @@ crossref_page = ui.page_fluid(
                              ui.output_text_verbatim(f"app_query_crossref_no_funders")
                          ),
 
+                         ui_card(
+                             ui.h4("DOIs not registered with Crossref:"),
+                             ui.output_text_verbatim("app_query_crossref_not_crossref")
+                         ),
+
+                         ui_card(
+                             ui.h4("Run statistics:"),
+                             ui.output_text_verbatim("app_query_crossref_run_report")
+                         ),
+
                          ui_card(
                              ui.h4("Nested dictionaries\n"),
                              ui.markdown(
@@ -153,7 +164,7 @@ clinicaltrials_page = ui.page_fluid(
     ui.panel_well(
         ui.h3("Upload a ", ui.tags.u("NCTID"), " file:"),
         ui.input_file("clinicaltrials_user_file", "Choose a file to upload:", multiple=False),
-        ui.input_radio_buttons("clinicaltrials_type", "Type:", ["Text", "Other"]),
+        ui.input_radio_buttons("clinicaltrials_type", "Type:", ["Text", "Bibliographic export"]),
     ),
 
     ui.panel_well(
@@ -218,6 +229,11 @@ clinicaltrials_page = ui.page_fluid(
                              ui.output_text_verbatim(f"app_query_clinicaltrials_no_funders")
                          ),
 
+                         ui_card(
+                             ui.h4("Run statistics:"),
+                             ui.output_text_verbatim("app_query_clinicaltrials_run_report")
+                         ),
+
                          ui_card(
                              ui.h4("Results dictionaries\n"),
                              ui.markdown(
@@ -239,6 +255,74 @@ clinicaltrials_page = ui.page_fluid(
     )
 )
 
+combined_page = ui.page_fluid(
+    ui.markdown(
+        """
+        # Querying Crossref and ClinicalTrials.gov together
+        ### What this page does:
+          This page takes a mixed list of DOIs and NCTIDs and queries [Crossref](https://www.crossref.org/)
+          and [ClinicalTrials.gov](https://clinicaltrials.gov/) at the same time. Trials that the Crossref
+          works list as clinical trial numbers are looked up too, so each work's funders can be compared
+          with the sponsors of its trials.
+        """
+    ),
+
+    ui.panel_well(
+        ui.h3("Enter ", ui.tags.u("DOIs and NCTIDs"), ":"),
+        ui.input_text_area("combined_identifiers",
+                           "One DOI (10.XXXX/XXXX) or NCTID (NCT########) per line",
+                           placeholder="Enter DOIs and NCTIDs here"),
+    ),
+
+    ui.panel_well(
+        ui.h3("Upload a ", ui.tags.u("DOI and NCTID"), " file:"),
+        ui.input_file("combined_user_file", "Choose a file to upload:", multiple=False),
+        ui.input_radio_buttons("combined_type", "Type:", ["Text", "Bibliographic export"]),
+    ),
+
+    ui.panel_well(
+        ui.h3("Input data"),
+        ui.output_text_verbatim("app_combined_clean_input_list"),
+        ui.h3("Click button to query both sources"),
+        ui.input_action_button("query_combined_button",
+                               "Query Crossref and ClinicalTrials.gov",
+                               class_="btn-success btn-lg",)
+    ),
+
+    ui.panel_well(
+        ui.h3("Results"),
+        ui.navset_card_tab(
+            ui.nav_panel("Work-to-trial table",
+                ui_card(
+                    ui.h4("Crossref funders and ClinicalTrials.gov sponsors of linked works and trials:"),
+                    ui.output_table("combined_linked_table"),
+                ),
+            ),
+
+            ui.nav_spacer(),
+
+            ui.nav_panel("Query results and errors",
+                         ui.h3("Query results and errors"),
+
+                         ui_card(
+                             ui.h4("Identifiers with errors:"),
+                             ui.output_text_verbatim("app_query_combined_errors")
+                         ),
+
+                         ui_card(
+                             ui.h4("Run statistics:"),
+                             ui.output_text_verbatim("app_query_combined_run_report")
+                         ),
+
+                         ui_card(
+                             ui.h4("Nested dictionaries"),
+                             ui.output_text_verbatim("app_query_combined_result")
+                         ),
+                         ),
+        ),
+    )
+)
+
 with open('how_to_instructions.md', 'r') as file:
     how_to_markdown_file = file.read()
 
@@ -255,6 +339,7 @@ app_ui = ui.page_navbar(
     ui.nav_spacer(),
     ui.nav_panel("Query Crossref", crossref_page),
     ui.nav_panel("Query ClinicalTrials.gov", clinicaltrials_page),
+    ui.nav_panel("Query both", combined_page),
     ui.nav_panel("How to use this app", how_to_page),
     ui.nav_panel("Example usage", example_page),
     title=ui.TagList(
@@ -265,3 +350,4 @@ app_ui = ui.page_navbar(
 )
 
 app = App(app_ui, server, debug=False)
+start_cache_refresher()
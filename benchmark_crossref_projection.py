@@ -0,0 +1,72 @@
+import json
+import sys
+import time
+
+from http_client import http_get, orjson
+from query_crossref import (crossref_read_input_file, crossref_clean_input_list,
+                            CROSSREF_PROJECTION_FIELDS)
+
+
+def time_parse(loads, content: bytes, repeat: int = 5):
+    """
+    Times how long a JSON decoder takes for one response body.
+
+    :param loads: JSON decoding function
+    :param content: raw response body
+    :param repeat: number of decodes to average over
+    :return: average parse time in seconds
+    """
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        loads(content)
+    return (time.perf_counter() - start_time) / repeat
+
+
+def benchmark_crossref_projection(identifier_list: list):
+    """
+    Downloads each DOI once as a full Work record and once as a "select=DOI,funder" projection,
+    then reports average bytes transferred and parse time per DOI for both.
+
+    :param identifier_list: list of DOIs in format "10.XXX/XXXX"
+    :return: dictionary of mode to average bytes and parse times per DOI
+    """
+    totals = {"full": {"bytes": 0, "json": 0.0, "orjson": 0.0},
+              "projected": {"bytes": 0, "json": 0.0, "orjson": 0.0}}
+    count = 0
+    for identifier in identifier_list:
+        full_response = http_get(f"https://api.crossref.org/works/{identifier}")
+        projected_response = http_get("https://api.crossref.org/works",
+                                      params={"filter": f"doi:{identifier}",
+                                              "select": CROSSREF_PROJECTION_FIELDS})
+        if full_response.status_code != 200 or projected_response.status_code != 200:
+            print(f"skipped: {identifier}")
+            continue
+
+        count += 1
+        for mode, response in (("full", full_response), ("projected", projected_response)):
+            # Content-Length reflects the bytes on the wire when the response was compressed.
+            totals[mode]["bytes"] += int(response.headers.get("Content-Length", len(response.content)))
+            totals[mode]["json"] += time_parse(json.loads, response.content)
+            if orjson is not None:
+                totals[mode]["orjson"] += time_parse(orjson.loads, response.content)
+
+    averages = {}
+    for mode, mode_totals in totals.items():
+        averages[mode] = {key: value / max(count, 1) for key, value in mode_totals.items()}
+
+    print(f"DOIs measured: {count}")
+    for mode, mode_averages in averages.items():
+        line = (f"{mode:>9}: {mode_averages['bytes'] / 1024:8.1f} KB/DOI, "
+                f"json {mode_averages['json'] * 1000:7.3f} ms/DOI")
+        if orjson is not None:
+            line += f", orjson {mode_averages['orjson'] * 1000:7.3f} ms/DOI"
+        print(line)
+    return averages
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark_crossref_projection.py [DOI file] [number of DOIs]
+    doi_file = sys.argv[1] if len(sys.argv) > 1 else "data/COVID-WFI-example.txt"
+    sample_size = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    dois = [doi for doi in crossref_clean_input_list(crossref_read_input_file(doi_file)) if doi.startswith("10.")]
+    benchmark_crossref_projection(sorted(dois)[:sample_size])
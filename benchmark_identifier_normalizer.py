@@ -0,0 +1,69 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+from query_crossref import crossref_read_input_file, crossref_clean_input_list
+from query_clinicaltrials import clinicaltrials_read_input_file, clinicaltrials_clean_input_list
+
+DOI_FORMATS = ["10.{prefix}/{suffix}", "doi:10.{prefix}/{suffix}", "DOI: 10.{prefix}/{suffix}",
+               "https://doi.org/10.{prefix}/{suffix}", "http://dx.doi.org/10.{prefix}/{suffix}",
+               "doi.org/10.{prefix}/{suffix}", "10.{prefix}/{suffix_upper}"]
+NCTID_FORMATS = ["NCT{number:08d}", "nct{number:08d}", "NCTID: NCT{number:08d}", "NCT{number}"]
+
+
+def create_identifier_file(path: str, line_count: int, kind: str, distinct_share: float = 0.5):
+    """
+    Writes a file of identifiers in the formats the cleaners accept, with CRLF line endings, blank lines and
+    duplicates in other spellings, as exported by citation managers.
+
+    :param path: path of the file to write
+    :param line_count: number of lines
+    :param kind: "doi" or "nctid"
+    :param distinct_share: share of lines that are a new identifier rather than a repeat
+    :return: None
+    """
+    random.seed(0)
+    distinct_count = max(1, int(line_count * distinct_share))
+    with open(path, "w", newline="\r\n") as file:
+        for _ in range(line_count):
+            number = random.randrange(distinct_count)
+            if number % 50 == 0:
+                file.write("\n")
+            elif kind == "doi":
+                suffix = f"journal.abc.{number}"
+                file.write(random.choice(DOI_FORMATS).format(prefix=1000 + number % 997, suffix=suffix,
+                                                             suffix_upper=suffix.upper()) + "\n")
+            else:
+                file.write(random.choice(NCTID_FORMATS).format(number=number) + "\n")
+
+
+def benchmark_identifier_normalizer(line_count: int = 1_000_000):
+    """
+    Times reading and cleaning a generated file of line_count DOIs and one of line_count NCTIDs.
+
+    :param line_count: number of lines per file
+    :return: dictionary of kind to (seconds, number of distinct identifiers)
+    """
+    results = {}
+    for kind, read_input_file, clean_input_list in (
+            ("doi", crossref_read_input_file, crossref_clean_input_list),
+            ("nctid", clinicaltrials_read_input_file, clinicaltrials_clean_input_list)):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, f"{kind}.txt")
+            create_identifier_file(path, line_count, kind)
+
+            start_time = time.perf_counter()
+            cleaned_count = sum(1 for _ in clean_input_list(read_input_file(path)))
+            elapsed = time.perf_counter() - start_time
+
+        results[kind] = (elapsed, cleaned_count)
+        print(f"{kind:>6}: {line_count} lines -> {cleaned_count} identifiers in {elapsed:.2f} s "
+              f"({line_count / elapsed / 1000:.0f}k lines/s)")
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark_identifier_normalizer.py [number of lines]
+    benchmark_identifier_normalizer(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
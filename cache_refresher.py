@@ -0,0 +1,126 @@
+import os
+import sys
+import threading
+import time
+
+from http_client import upstream_session, open_sessions, record_run, MAX_RETRIES
+from query_crossref import crossref_fetch_work, crossref_fetch_funder_record, retrieve_funder_ancestry
+from query_clinicaltrials import clinicaltrials_fetch_study
+from result_cache import (CACHE_PATH, cache_refresh_candidates, cache_forget_demand, cache_get, forced_revalidation,
+                          untracked_demand)
+
+# "thread" runs the refresher inside the app process, "off" leaves it to "python cache_refresher.py".
+CACHE_REFRESHER = os.environ.get("WHOFUNDEDIT_CACHE_REFRESHER", "thread")
+# Local hours in which refreshing is allowed, "start-end" with the end excluded; may wrap around midnight.
+REFRESH_HOURS = os.environ.get("WHOFUNDEDIT_REFRESH_HOURS", "1-6")
+REFRESH_REQUEST_BUDGET = int(os.environ.get("WHOFUNDEDIT_REFRESH_BUDGET", 500))  # Upstream requests per cycle.
+REFRESH_INTERVAL = 3600.0  # Seconds between refresh cycles.
+REFRESH_AHEAD = 24 * 3600.0  # Entries expiring within this many seconds are refreshed.
+DEMAND_WINDOW = 30 * 24 * 3600.0  # Items not looked up for this many seconds are no longer refreshed.
+REFRESHER_SESSION_ID = "cache-refresher"
+
+REFRESH_FUNCTIONS = {
+    "crossref-work": crossref_fetch_work,
+    "crossref-funder": lambda funder_id: crossref_fetch_funder_record(
+        f"https://data.crossref.org/fundingdata/funder/10.13039/{funder_id}"),
+    "crossref-rest-funder": lambda funder_id: retrieve_funder_ancestry(f"10.13039/{funder_id}"),
+    "clinicaltrials-study": clinicaltrials_fetch_study,
+}
+
+_refresher_thread = None
+_refresher_lock = threading.Lock()
+
+
+def is_off_peak(now: float = None):
+    """
+    Checks whether the local time is inside REFRESH_HOURS.
+
+    :param now: time to check, defaults to the current time
+    :return: True if refreshing is allowed at this hour
+    """
+    start_hour, end_hour = (int(hour) for hour in REFRESH_HOURS.split("-"))
+    hour = time.localtime(now).tm_hour
+    if start_hour <= end_hour:
+        return start_hour <= hour < end_hour
+    return hour >= start_hour or hour < end_hour
+
+
+def refresh_hot_entries(request_budget: int = REFRESH_REQUEST_BUDGET, ignore_hours: bool = False):
+    """
+    Revalidates the most requested cache entries that are about to expire, so users find them fresh. Entries
+    are refreshed most requested first until the request budget is spent, the off-peak hours end or a user
+    starts a query in this process. Refresh requests are scheduled as bulk work behind interactive ones.
+    Entries are revalidated while still fresh, so one whose upstream cannot be reached keeps its remaining
+    lifetime. Every attempt, retries included, counts against the budget, which is never exceeded.
+
+    :param request_budget: maximum number of upstream requests to send
+    :param ignore_hours: refresh even outside REFRESH_HOURS
+    :return: number of entries refreshed and number of upstream requests sent
+    """
+    now = time.time()
+    cache_forget_demand(now - DEMAND_WINDOW)
+    candidate_list = cache_refresh_candidates(list(REFRESH_FUNCTIONS), now + REFRESH_AHEAD, now - DEMAND_WINDOW,
+                                              request_budget)
+    refreshed_count = 0
+    failed_count = 0
+    with record_run() as run_statistics, upstream_session(REFRESHER_SESSION_ID), untracked_demand(), \
+            forced_revalidation():
+        for kind, key in candidate_list:
+            # Stop while the budget still covers a lookup that uses up all its retries.
+            if run_statistics["counts"]["upstream requests"] + MAX_RETRIES + 1 > request_budget \
+                    or open_sessions() - {REFRESHER_SESSION_ID} or not (ignore_hours or is_off_peak()):
+                break
+            started_at = time.time()
+            REFRESH_FUNCTIONS[kind](key)
+            # A successful refresh renews or replaces the entry, a failed one leaves it untouched.
+            cached = cache_get(kind, key)
+            if cached is not None and cached["fetched_at"] >= started_at:
+                refreshed_count += 1
+            else:
+                failed_count += 1
+    request_count = run_statistics["counts"]["upstream requests"]
+    print(f"cache refresher: {refreshed_count} entries refreshed ({run_statistics['counts']['cache revalidated']} "
+          f"unchanged), {failed_count} failed, with {request_count} requests")
+    return refreshed_count, request_count
+
+
+def run_cache_refresher(stop_event: threading.Event = None):
+    """
+    Runs refresh_hot_entries every REFRESH_INTERVAL seconds during the off-peak hours until stop_event is set.
+
+    :param stop_event: event that ends the loop, runs forever if None
+    """
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        if is_off_peak():
+            try:
+                refresh_hot_entries()
+            except Exception as error:
+                print(f"cache refresher failed: {error!r}")
+        stop_event.wait(REFRESH_INTERVAL)
+
+
+def start_cache_refresher():
+    """
+    Starts the refresher in a daemon thread of the app process, once, unless WHOFUNDEDIT_CACHE_REFRESHER is
+    "off" or the result cache is disabled.
+
+    :return: the refresher thread, or None if it is not run in this process
+    """
+    global _refresher_thread
+    if CACHE_REFRESHER != "thread" or not CACHE_PATH:
+        return None
+    with _refresher_lock:
+        if _refresher_thread is None:
+            _refresher_thread = threading.Thread(target=run_cache_refresher, name="cache-refresher", daemon=True)
+            _refresher_thread.start()
+    return _refresher_thread
+
+
+if __name__ == "__main__":
+    # Usage: python cache_refresher.py [--once]
+    # --once refreshes immediately, regardless of the hour, and exits.
+    if "--once" in sys.argv[1:]:
+        refresh_hot_entries(ignore_hours=True)
+    else:
+        run_cache_refresher()
@@ -0,0 +1,112 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import zipfile
+
+from http_client import json_loads
+
+CLINICALTRIALS_BULK_DATA_INDEX_PATH = os.environ.get("CLINICALTRIALS_BULK_DATA_INDEX",
+                                                     "data/clinicaltrials_bulk_data_index.sqlite3")
+CLINICALTRIALS_BULK_DATA_COMMIT_SIZE = 5000  # Studies written per transaction.
+
+_connections = threading.local()
+
+
+def clinicaltrials_bulk_data_studies(archive_path: str):
+    """
+    Streams the studies of a ClinicalTrials.gov bulk download (https://clinicaltrials.gov/api/v2/studies/download
+    ?format=json.zip, one JSON file per study) one at a time.
+
+    :param archive_path: path to the ZIP archive
+    :return: generator of decoded study records
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            if not member.is_dir() and member.filename.endswith(".json"):
+                yield json_loads(archive.read(member))
+
+
+def build_clinicaltrials_bulk_data_index(archive_path: str, index_path: str = CLINICALTRIALS_BULK_DATA_INDEX_PATH):
+    """
+    Keeps only the NCTID and sponsor/collaborator module of every study in a ClinicalTrials.gov bulk download and
+    writes them to an on-disk index keyed by upper-case NCTID. Studies are read one at a time, so memory use does
+    not grow with the size of the archive. Studies already in the index are replaced by the newer download.
+
+    :param archive_path: path to the ZIP archive
+    :param index_path: path of the SQLite index
+    :return: number of studies written
+    """
+    connection = sqlite3.connect(index_path)
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("CREATE TABLE IF NOT EXISTS studies (nct_id TEXT PRIMARY KEY, sponsors TEXT) WITHOUT ROWID")
+
+    study_count = 0
+    rows = []
+    for study in clinicaltrials_bulk_data_studies(archive_path):
+        protocol_section = study.get('protocolSection', {})
+        identifier = protocol_section.get('identificationModule', {}).get('nctId')
+        if identifier is None:
+            continue
+        module = protocol_section.get('sponsorCollaboratorsModule')
+        rows.append((identifier.upper(), json.dumps(module, separators=(",", ":")) if module else None))
+        if len(rows) >= CLINICALTRIALS_BULK_DATA_COMMIT_SIZE:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO studies VALUES (?, ?)", rows)
+            study_count += len(rows)
+            rows = []
+            print(f"{study_count} studies indexed")
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO studies VALUES (?, ?)", rows)
+    study_count += len(rows)
+    connection.close()
+    return study_count
+
+
+def clinicaltrials_bulk_data_available(index_path: str = CLINICALTRIALS_BULK_DATA_INDEX_PATH):
+    """
+    Checks whether a bulk download index has been built.
+
+    :param index_path: path of the SQLite index
+    :return: True if the index exists
+    """
+    return os.path.exists(index_path)
+
+
+def clinicaltrials_bulk_data_lookup(cleaned_input_list: list, index_path: str = CLINICALTRIALS_BULK_DATA_INDEX_PATH):
+    """
+    Looks NCTIDs up in the bulk download index without any network request.
+
+    :param cleaned_input_list: input list of NCTIDs in format "NCT########"
+    :param index_path: path of the SQLite index
+    :return: dictionary of NCTID to protocol section (only the sponsor/collaborator module, if the study has
+    one), for the NCTIDs in the index
+    """
+    if not clinicaltrials_bulk_data_available(index_path):
+        return {}
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        _connections.connection = connection
+
+    identifier_lookup = {}
+    for identifier in cleaned_input_list:
+        identifier_lookup.setdefault(identifier.upper(), identifier)
+    key_list = list(identifier_lookup)
+    protocol_section_dictionary = {}
+    for start in range(0, len(key_list), 500):
+        key_batch = key_list[start:start + 500]
+        rows = connection.execute(f"SELECT nct_id, sponsors FROM studies "
+                                  f"WHERE nct_id IN ({','.join('?' * len(key_batch))})", key_batch)
+        for identifier, sponsors in rows:
+            protocol_section_dictionary[identifier_lookup[identifier]] \
+                = {"sponsorCollaboratorsModule": json_loads(sponsors)} if sponsors is not None else {}
+    return protocol_section_dictionary
+
+
+if __name__ == "__main__":
+    # Usage: python clinicaltrials_bulk_data.py ctg-studies.json.zip [index path]
+    indexed_count = build_clinicaltrials_bulk_data_index(*sys.argv[1:3])
+    print(f"Indexed {indexed_count} studies")
@@ -0,0 +1,138 @@
+import argparse
+import itertools
+import json
+from collections import Counter
+
+from http_client import http_get, json_loads, record_run, latency_report
+from query_crossref import (crossref_resolve_funder_identifiers, crossref_hierarchy_requests_saved,
+                            crossref_normalize_funders, CROSSREF_PROJECTION_FIELDS)
+
+CROSSREF_HARVEST_ROWS = 1000  # Largest page Crossref serves with cursor paging.
+
+
+def crossref_build_harvest_filter(funder: str = None, issn: str = None, member: str = None,
+                                  from_date: str = None, until_date: str = None):
+    """
+    Builds a Crossref "/works" filter from the criteria of a harvest.
+
+    :param funder: funder identifier, e.g. "10.13039/100000002" or "100000002"
+    :param issn: ISSN of a journal
+    :param member: Crossref member id of a publisher
+    :param from_date: earliest publication date, "YYYY", "YYYY-MM" or "YYYY-MM-DD"
+    :param until_date: latest publication date, same formats
+    :return: filter string, e.g. "funder:10.13039/100000002,from-pub-date:2023"
+    """
+    filter_list = []
+    if funder:
+        filter_list.append(f"funder:{funder if funder.startswith('10.') else f'10.13039/{funder}'}")
+    if issn:
+        filter_list.append(f"issn:{issn}")
+    if member:
+        filter_list.append(f"member:{member}")
+    if from_date:
+        filter_list.append(f"from-pub-date:{from_date}")
+    if until_date:
+        filter_list.append(f"until-pub-date:{until_date}")
+    return ",".join(filter_list)
+
+
+def crossref_harvest_pages(filter_string: str, cursor: str = "*", rows: int = CROSSREF_HARVEST_ROWS):
+    """
+    Streams all works matching a filter from Crossref with deep cursor paging, only downloading the DOI and
+    funder fields. Only one page is held in memory at a time.
+
+    :param filter_string: Crossref "/works" filter, see crossref_build_harvest_filter
+    :param cursor: cursor to start from, "*" for the first page or the cursor printed by an interrupted harvest
+    :param rows: works per page
+    :return: generator of (list of works, cursor of the next page) pairs
+    """
+    params = {"filter": filter_string, "select": CROSSREF_PROJECTION_FIELDS, "rows": rows}
+    while True:
+        response = http_get("https://api.crossref.org/works", params=dict(params, cursor=cursor))
+        response.raise_for_status()
+        message = json_loads(response.content)['message']
+        items = message['items']
+        if not items:
+            return
+        cursor = message['next-cursor']
+        yield items, cursor
+
+
+def crossref_harvest(filter_string: str, output_path: str, cursor: str = "*", max_workers: int = 8,
+                     hierarchy_source: str = "registry"):
+    """
+    Harvests all works matching a filter and appends one JSON line per work to output_path, with the same
+    normalized funder structures that query_crossref returns. Each page is written before the next one is
+    requested, so memory stays bounded by the page size and the number of distinct funders, however many
+    works match. Funder hierarchies are resolved once per harvest, and the hierarchy requests this saves are
+    printed at the end.
+
+    :param filter_string: Crossref "/works" filter, see crossref_build_harvest_filter
+    :param output_path: JSON Lines file to append to
+    :param cursor: cursor to start from, "*" for a new harvest or the last cursor printed to resume one
+    :param max_workers: number of concurrent funder hierarchy requests
+    :param hierarchy_source: "registry", "rest" or "index", see query_crossref
+    :return: number of works written
+    """
+    resolved_funder_dictionary = {}
+    funder_occurrence_count = Counter()
+    hierarchy_request_count = 0
+    no_funder_doi_counter = itertools.count(1)
+    work_count = 0
+
+    with record_run() as run_statistics, open(output_path, "a") as file:
+        for items, next_cursor in crossref_harvest_pages(filter_string, cursor):
+            bottom_level_funder_dictionary = {item['DOI']: item.get('funder', []) for item in items}
+            page_occurrence_count = Counter(funder["DOI"] for funders_list in bottom_level_funder_dictionary.values()
+                                            for funder in funders_list if funder.get("DOI"))
+            funder_occurrence_count.update(page_occurrence_count)
+            new_funder_identifier_list = [funder_identifier for funder_identifier in page_occurrence_count
+                                          if funder_identifier not in resolved_funder_dictionary]
+            if new_funder_identifier_list:
+                page_resolved_dictionary, request_count = crossref_resolve_funder_identifiers(
+                    new_funder_identifier_list, max_workers, hierarchy_source)
+                resolved_funder_dictionary.update(page_resolved_dictionary)
+                hierarchy_request_count += request_count
+
+            for identifier, funders_list in bottom_level_funder_dictionary.items():
+                (detailed_funder_list,
+                 funding_body_type_list,
+                 country_list,
+                 grant_list) = crossref_normalize_funders(funders_list, resolved_funder_dictionary,
+                                                          no_funder_doi_counter)
+                file.write(json.dumps({"DOI": identifier,
+                                       "bottom_level_funders": funders_list,
+                                       "detailed_funders": detailed_funder_list,
+                                       "funding_body_types": funding_body_type_list,
+                                       "countries": country_list,
+                                       "grants": grant_list}) + "\n")
+            file.flush()
+            work_count += len(items)
+            print(f"harvested {work_count} works, next cursor: {next_cursor}")
+
+    print(f"latency: {latency_report(run_statistics['latency'])}")
+    requests_saved = crossref_hierarchy_requests_saved(resolved_funder_dictionary, funder_occurrence_count,
+                                                       hierarchy_request_count, hierarchy_source)
+    print(f"hierarchy requests saved: {requests_saved}")
+    return work_count
+
+
+if __name__ == "__main__":
+    # Usage: python crossref_harvest.py --funder 100000002 --from-date 2023 --until-date 2023 nih_2023.jsonl
+    parser = argparse.ArgumentParser(description="Harvest the funders of all Crossref works matching a filter.")
+    parser.add_argument("output_path", help="JSON Lines file to append the works to")
+    parser.add_argument("--funder", help="funder identifier, e.g. 10.13039/100000002")
+    parser.add_argument("--issn", help="journal ISSN")
+    parser.add_argument("--member", help="Crossref member id")
+    parser.add_argument("--from-date", help="earliest publication date, YYYY[-MM[-DD]]")
+    parser.add_argument("--until-date", help="latest publication date, YYYY[-MM[-DD]]")
+    parser.add_argument("--cursor", default="*", help="cursor printed by an interrupted harvest, to resume it")
+    parser.add_argument("--hierarchy-source", default="registry", choices=["registry", "rest", "index"])
+    arguments = parser.parse_args()
+
+    harvest_filter = crossref_build_harvest_filter(arguments.funder, arguments.issn, arguments.member,
+                                                   arguments.from_date, arguments.until_date)
+    if not harvest_filter:
+        parser.error("give at least one of --funder, --issn, --member, --from-date or --until-date")
+    crossref_harvest(harvest_filter, arguments.output_path, arguments.cursor,
+                     hierarchy_source=arguments.hierarchy_source)
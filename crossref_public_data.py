@@ -0,0 +1,121 @@
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import tarfile
+import threading
+
+from http_client import json_loads
+
+CROSSREF_PUBLIC_DATA_INDEX_PATH = os.environ.get("CROSSREF_PUBLIC_DATA_INDEX",
+                                                 "data/crossref_public_data_index.sqlite3")
+
+_connections = threading.local()
+
+
+def crossref_public_data_files(dump_path: str):
+    """
+    Streams the gzipped JSON files of a Crossref public data file one at a time, from the tarball as published
+    or from a directory it was extracted to.
+
+    :param dump_path: path to the tarball or directory
+    :return: generator of (file name, decoded JSON) pairs
+    """
+    if os.path.isdir(dump_path):
+        for file_name in sorted(os.listdir(dump_path)):
+            if file_name.endswith(".json.gz"):
+                with gzip.open(os.path.join(dump_path, file_name), "rb") as file:
+                    yield file_name, json_loads(file.read())
+        return
+
+    # "r|*" reads the tarball front to back without seeking, so it also works on a pipe.
+    with tarfile.open(dump_path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith(".json.gz"):
+                with gzip.GzipFile(fileobj=archive.extractfile(member)) as file:
+                    yield member.name, json_loads(file.read())
+
+
+def build_crossref_public_data_index(dump_path: str, index_path: str = CROSSREF_PUBLIC_DATA_INDEX_PATH):
+    """
+    Extracts the DOI, funder and clinical-trial-number fields of every work in a Crossref public data file into
+    an on-disk index keyed by lower-case DOI. Files are read and written one at a time, so memory use does not
+    grow with the size of the dump. Works already in the index are replaced, so a newer dump can be ingested
+    over an older one.
+
+    :param dump_path: path to the public data file tarball, or the directory it was extracted to
+    :param index_path: path of the SQLite index
+    :return: number of works written
+    """
+    connection = sqlite3.connect(index_path)
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("CREATE TABLE IF NOT EXISTS works (doi TEXT PRIMARY KEY, funder TEXT, "
+                       "clinical_trial_number TEXT) WITHOUT ROWID")
+
+    work_count = 0
+    for file_count, (file_name, result) in enumerate(crossref_public_data_files(dump_path), 1):
+        rows = [(item['DOI'].lower(),
+                 json.dumps(item['funder'], separators=(",", ":")) if item.get('funder') else None,
+                 json.dumps(item['clinical-trial-number'], separators=(",", ":"))
+                 if item.get('clinical-trial-number') else None)
+                for item in result.get('items', []) if item.get('DOI')]
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO works VALUES (?, ?, ?)", rows)
+        work_count += len(rows)
+        if file_count % 1000 == 0:
+            print(f"{file_count} files, {work_count} works indexed ({file_name})")
+    connection.close()
+    return work_count
+
+
+def crossref_public_data_available(index_path: str = CROSSREF_PUBLIC_DATA_INDEX_PATH):
+    """
+    Checks whether a public data file index has been built.
+
+    :param index_path: path of the SQLite index
+    :return: True if the index exists
+    """
+    return os.path.exists(index_path)
+
+
+def crossref_public_data_lookup(cleaned_input_list: list, index_path: str = CROSSREF_PUBLIC_DATA_INDEX_PATH):
+    """
+    Looks DOIs up in the public data file index without any network request.
+
+    :param cleaned_input_list: input list of DOIs in format "10.XXX/XXXX"
+    :param index_path: path of the SQLite index
+    :return: dictionary of DOI to Work metadata with the DOI and (if the work lists any) funder and
+    clinical-trial-number fields, for the DOIs in the index
+    """
+    if not crossref_public_data_available(index_path):
+        return {}
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        _connections.connection = connection
+
+    identifier_lookup = {}
+    for identifier in cleaned_input_list:
+        identifier_lookup.setdefault(identifier.lower(), identifier)
+    key_list = list(identifier_lookup)
+    work_metadata_dictionary = {}
+    for start in range(0, len(key_list), 500):
+        key_batch = key_list[start:start + 500]
+        rows = connection.execute(f"SELECT doi, funder, clinical_trial_number FROM works "
+                                  f"WHERE doi IN ({','.join('?' * len(key_batch))})", key_batch)
+        for doi, funder, clinical_trial_number in rows:
+            metadata = {"DOI": doi}
+            if funder is not None:
+                metadata["funder"] = json_loads(funder)
+            if clinical_trial_number is not None:
+                metadata["clinical-trial-number"] = json_loads(clinical_trial_number)
+            work_metadata_dictionary[identifier_lookup[doi]] = metadata
+    return work_metadata_dictionary
+
+
+if __name__ == "__main__":
+    # Usage: python crossref_public_data.py "April 2025 Public Data File from Crossref.tar" [index path]
+    indexed_count = build_crossref_public_data_index(*sys.argv[1:3])
+    print(f"Indexed {indexed_count} works")
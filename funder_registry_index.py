@@ -0,0 +1,148 @@
+import json
+import os
+import sys
+import threading
+
+from http_client import json_loads
+
+FUNDER_REGISTRY_INDEX_PATH = os.environ.get("FUNDER_REGISTRY_INDEX", "data/funder_registry_index.json")
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def local_name(uri: str):
+    """
+    Returns the last part of an RDF predicate or resource URI, e.g. "broader" for
+    "http://www.w3.org/2004/02/skos/core#broader" or "100000002" for "http://dx.doi.org/10.13039/100000002".
+
+    :param uri: URI
+    :return: part after the last "#" or "/"
+    """
+    return uri.rstrip('/').rsplit('#', 1)[-1].rsplit('/', 1)[-1]
+
+
+def rdf_values(graph: dict, subject: str, predicate: str):
+    """
+    Returns the objects of all triples with a subject and a predicate (matched by local name) in an RDF/JSON graph.
+
+    :param graph: RDF/JSON graph, {subject: {predicate: [{"type": ..., "value": ...}]}}
+    :param subject: subject URI or blank node id
+    :param predicate: local name of the predicate, e.g. "broader"
+    :return: list of object values
+    """
+    values = []
+    for predicate_uri, objects in graph.get(subject, {}).items():
+        if local_name(predicate_uri) == predicate:
+            values.extend(rdf_object["value"] for rdf_object in objects)
+    return values
+
+
+def rdf_path_value(graph: dict, subject: str, predicates: list):
+    """
+    Follows a chain of predicates from a subject, e.g. prefLabel -> literalForm, and returns the first value found.
+
+    :param graph: RDF/JSON graph
+    :param subject: subject URI or blank node id
+    :param predicates: local names of the predicates to follow
+    :return: value at the end of the chain, or None
+    """
+    values = [subject]
+    for predicate in predicates:
+        values = [value for node in values for value in rdf_values(graph, node, predicate)]
+    return values[0] if values else None
+
+
+def build_funder_registry_index(dump_path: str, index_path: str = FUNDER_REGISTRY_INDEX_PATH):
+    """
+    Compiles the Crossref Funder Registry RDF/JSON dump into a compact index with, for every funder, its name,
+    broader parent, funding body type, country and the precomputed chain of names from the top-level funder
+    down to it.
+
+    :param dump_path: path to the Funder Registry dump in RDF/JSON format
+    :param index_path: path to write the index to
+    :return: number of funders in the index
+    """
+    with open(dump_path, "rb") as file:
+        graph = json_loads(file.read())
+
+    funders = {}
+    for subject in graph:
+        name = rdf_path_value(graph, subject, ["prefLabel", "literalForm"])
+        if name is None or "10.13039/" not in subject:
+            continue
+        broader = rdf_path_value(graph, subject, ["broader"])
+        funders[local_name(subject)] = {
+            "name": name,
+            "broader": local_name(broader) if broader else None,
+            "type": rdf_path_value(graph, subject, ["fundingBodySubType"]),
+            "country": rdf_path_value(graph, subject, ["address", "postalAddress", "addressCountry"]),
+        }
+
+    index = {}
+    for funder_id, funder in funders.items():
+        path = []
+        visited_ids = set()
+        node_id = funder_id
+        while node_id in funders and node_id not in visited_ids:
+            visited_ids.add(node_id)
+            path.append(funders[node_id]["name"])
+            node_id = funders[node_id]["broader"]
+        index[funder_id] = [path[::-1], funder["type"], funder["country"]]
+
+    with open(index_path, "w") as file:
+        json.dump(index, file, separators=(",", ":"))
+    return len(index)
+
+
+def funder_registry_index_available(index_path: str = FUNDER_REGISTRY_INDEX_PATH):
+    """
+    Checks whether a funder registry index has been built.
+
+    :param index_path: path to the index written by build_funder_registry_index
+    :return: True if the index exists
+    """
+    return os.path.exists(index_path)
+
+
+def load_funder_registry_index(index_path: str = FUNDER_REGISTRY_INDEX_PATH):
+    """
+    Loads the funder index into memory on first use.
+
+    :param index_path: path to the index written by build_funder_registry_index
+    :return: dictionary of funder id to [names from top-level funder down, funding body type, country],
+    or an empty dictionary if there is no index
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                try:
+                    with open(index_path, "rb") as file:
+                        _index = json_loads(file.read())
+                except FileNotFoundError:
+                    print(f"No funder registry index at {index_path}")
+                    _index = {}
+    return _index
+
+
+def resolve_funder_from_index(funder_identifier: str):
+    """
+    Looks up a funder's hierarchy in the local index without any network request.
+
+    :param funder_identifier: Identifier of a given funder in Crossref, e.g. "10.13039/100000050"
+    :return: same as retrieve_broader_data, or None if the funder is not in the index
+    """
+    entry = load_funder_registry_index().get(local_name(funder_identifier))
+    if entry is None:
+        return None
+    funders, funding_body, funding_country = entry
+    return ({funder_identifier: list(funders)},
+            {funder_identifier: [funding_body]},
+            {funder_identifier: [funding_country]})
+
+
+if __name__ == "__main__":
+    # Usage: python funder_registry_index.py registry.json [index path]
+    funder_count = build_funder_registry_index(*sys.argv[1:3])
+    print(f"Indexed {funder_count} funders")
@@ -0,0 +1,828 @@
+import contextlib
+import contextvars
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import requests
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # HTTP/2 is only used when httpx is installed together with its "http2" extra (the h2 package).
+    import httpx
+    import h2
+except ImportError:
+    httpx = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+USE_HTTP2 = True
+POOL_CONNECTIONS = 10  # Number of hosts to keep a connection pool for.
+POOL_MAXSIZE = 32  # Keep-alive connections per host, should be at least the number of concurrent workers.
+USER_AGENT = "WhoFundedIt (https://github.com/infoqualitylab/WhoFundedIt-app)"
+
+# Starting budgets (requests, interval in seconds) per upstream host. Crossref budgets are replaced by the
+# X-Rate-Limit-Limit/X-Rate-Limit-Interval headers it sends, ClinicalTrials.gov publishes no limit.
+HOST_RATE_LIMITS = {"api.crossref.org": (50, 1.0),
+                    "data.crossref.org": (50, 1.0),
+                    "clinicaltrials.gov": (50, 1.0)}
+DEFAULT_RATE_LIMIT = (10, 1.0)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Exceptions that are retried and count against the circuit breaker; anything else (invalid URLs, programming
+# errors) is raised straight away.
+RETRY_EXCEPTIONS = (requests.Timeout, requests.ConnectionError) + (
+    (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) if httpx is not None else ())
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5  # Seconds before the first retry, doubled for each further attempt.
+BACKOFF_MAX = 30.0
+INTERACTIVE_LOOKUP_SIZE = 10  # Runs with at most this many identifiers are scheduled ahead of bulk uploads.
+CONNECT_TIMEOUT = 5.0  # Seconds to establish a connection.
+READ_TIMEOUT = 30.0  # Seconds to wait for the server between bytes of the response.
+HEDGE_PERCENTILE = 95  # A request slower than this percentile of recent requests to its host is hedged.
+HEDGE_MIN_SAMPLES = 20  # Recent requests needed before the percentile is trusted.
+RECENT_LATENCY_WINDOW = 500
+CIRCUIT_WINDOW = 20  # Outcomes of recent requests per host used to compute the error rate.
+CIRCUIT_MIN_REQUESTS = 10  # Requests needed in the window before the circuit can open.
+CIRCUIT_ERROR_THRESHOLD = 0.5  # Error rate at which the circuit opens.
+CIRCUIT_RESET_TIMEOUT = 30.0  # Seconds an open circuit fails fast before a probe request is let through.
+LAST_KNOWN_GOOD_SIZE = 100000  # Entries of last known good data kept for stale fallback.
+RETRY_PASS_DELAY = 2.0  # Seconds to wait before the end-of-run retry of transient failures.
+# Failure categories for which asking again gives the same answer; all other categories are transient.
+PERMANENT_FAILURE_CATEGORIES = {"not found", "invalid identifier"}
+
+_request_context = contextvars.ContextVar("request_context", default=("default", False))
+_run_statistics = contextvars.ContextVar("run_statistics", default=None)
+_run_statistics_lock = threading.Lock()  # Guards the dictionaries of runs recorded by record_run.
+_recent_latencies = defaultdict(lambda: deque(maxlen=RECENT_LATENCY_WINDOW))
+_recent_latencies_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=POOL_MAXSIZE, thread_name_prefix="hedge")
+_client = None
+_client_lock = threading.Lock()
+_statistics = defaultdict(lambda: {"requests": 0, "errors": 0, "bytes": 0, "coalesced": 0})
+_statistics_lock = threading.Lock()
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+_last_known_good = OrderedDict()
+_last_known_good_lock = threading.Lock()
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_open_sessions = Counter()
+_open_sessions_lock = threading.Lock()
+_run_exit_callbacks = []
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker for its host is open.
+    """
+
+
+def json_loads(content: bytes):
+    """
+    Decodes a JSON response body, using orjson when it is installed and the standard library otherwise.
+
+    :param content: raw response body
+    :return: decoded JSON object
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+@contextlib.contextmanager
+def upstream_session(session_id: str, interactive: bool = False):
+    """
+    Tags all requests made inside the block with the session that made them, so the process-wide scheduler can
+    share each host's budget fairly between sessions.
+
+    :param session_id: identifier of the user session, e.g. the Shiny session id
+    :param interactive: schedule the session's requests ahead of bulk work
+    """
+    token = _request_context.set((session_id, interactive))
+    with _open_sessions_lock:
+        _open_sessions[session_id] += 1
+    try:
+        yield
+    finally:
+        with _open_sessions_lock:
+            _open_sessions[session_id] -= 1
+            if not _open_sessions[session_id]:
+                del _open_sessions[session_id]
+        _request_context.reset(token)
+
+
+def open_sessions():
+    """
+    Returns the sessions that currently have an upstream_session block open in this process.
+
+    :return: set of session ids
+    """
+    with _open_sessions_lock:
+        return set(_open_sessions)
+
+
+def run_in_request_context(function):
+    """
+    Wraps a function so that worker threads run it with the context (session tag, latency recording) of the
+    thread that wrapped it.
+
+    :param function: function to call from worker threads
+    :return: wrapped function
+    """
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def record_run():
+    """
+    Collects statistics about the requests made inside the block for an end-of-run report: the latency of
+    every request per host, the items that were served from stale data, the items that could not be retrieved
+    and why, and named counters (e.g. cache hits, and "upstream requests" for every attempt sent, retries and
+    hedged copies included).
+
+    :return: dictionary with "latency" (host to list of latencies in seconds), "stale" (list of items),
+    "failures" (item to failure category), "counts" (Counter) and "demand" (Counter of (kind, key) lookups),
+    filled in as requests complete
+    """
+    run_statistics = {"latency": defaultdict(list), "stale": [], "failures": {}, "counts": Counter(),
+                      "demand": Counter()}
+    token = _run_statistics.set(run_statistics)
+    try:
+        yield run_statistics
+    finally:
+        _run_statistics.reset(token)
+        for callback in _run_exit_callbacks:
+            callback(run_statistics)
+
+
+def on_run_exit(callback):
+    """
+    Registers a function that is called with the statistics of each run when its record_run block ends, e.g.
+    to write what was collected during the run in one go.
+
+    :param callback: function taking the run statistics dictionary
+    """
+    _run_exit_callbacks.append(callback)
+
+
+def percentile(values: list, percent: float):
+    """
+    Nearest-rank percentile of a list of numbers.
+
+    :param values: list of numbers
+    :param percent: percentile between 0 and 100
+    :return: percentile value, or None for an empty list
+    """
+    if not values:
+        return None
+    sorted_values = sorted(values)
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def latency_report(latencies: dict):
+    """
+    Summarises recorded latencies as p50/p95/p99 per host.
+
+    :param latencies: dictionary of host to list of latencies in seconds, see record_run
+    :return: dictionary of host to request count and p50/p95/p99 latency in seconds
+    """
+    report = {}
+    for host, host_latencies in latencies.items():
+        report[host] = {"requests": len(host_latencies),
+                        "p50": percentile(host_latencies, 50),
+                        "p95": percentile(host_latencies, 95),
+                        "p99": percentile(host_latencies, 99)}
+    return report
+
+
+def record_latency(host: str, latency: float):
+    """
+    Stores a request latency for hedging decisions and for the current run's report, if one is recorded.
+
+    :param host: host name
+    :param latency: seconds from sending the request to receiving the full response
+    """
+    with _recent_latencies_lock:
+        _recent_latencies[host].append(latency)
+    run_statistics = _run_statistics.get()
+    if run_statistics is not None:
+        with _run_statistics_lock:
+            run_statistics["latency"][host].append(latency)
+
+
+def remember_good(kind: str, key: str, data):
+    """
+    Keeps the most recent successfully retrieved data for an item, to fall back on when its upstream fails.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key: normalized identifier of the item
+    :param data: decoded data
+    """
+    with _last_known_good_lock:
+        _last_known_good[(kind, key)] = data
+        _last_known_good.move_to_end((kind, key))
+        if len(_last_known_good) > LAST_KNOWN_GOOD_SIZE:
+            _last_known_good.popitem(last=False)
+
+
+def count_in_run(name: str, amount: int = 1):
+    """
+    Adds to a named counter of the current run, if one is recorded.
+
+    :param name: counter name, e.g. "cache hits"
+    :param amount: amount to add
+    """
+    run_statistics = _run_statistics.get()
+    if run_statistics is not None:
+        with _run_statistics_lock:
+            run_statistics["counts"][name] += amount
+
+
+def record_demand(kind: str, key_list: list):
+    """
+    Counts lookups of items in the current run, if one is recorded.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key_list: normalized identifiers
+    :return: True if the lookups were counted, False if no run is recorded
+    """
+    run_statistics = _run_statistics.get()
+    if run_statistics is None:
+        return False
+    with _run_statistics_lock:
+        run_statistics["demand"].update((kind, key) for key in key_list)
+    return True
+
+
+def record_stale(label: str):
+    """
+    Records in the current run that an item was served from stale data.
+
+    :param label: how the item is listed in the run report
+    """
+    run_statistics = _run_statistics.get()
+    if run_statistics is not None:
+        with _run_statistics_lock:
+            run_statistics["stale"].append(label)
+
+
+def classify_failure(error: Exception = None, status_code: int = None):
+    """
+    Sorts a failed lookup into a category for the run report and the negative cache. "not found" and
+    "invalid identifier" are permanent (see PERMANENT_FAILURE_CATEGORIES), all others are transient.
+
+    :param error: exception raised by the lookup, if any
+    :param status_code: HTTP status code of the response, if there was one
+    :return: failure category, e.g. "not found", "timeout" or "server error"
+    """
+    if status_code is None and getattr(error, "response", None) is not None:
+        status_code = error.response.status_code
+    if status_code is not None:
+        if status_code in (404, 410):
+            return "not found"
+        if status_code == 400:
+            return "invalid identifier"
+        if status_code == 429:
+            return "rate limited"
+        if status_code >= 500:
+            return "server error"
+        return f"HTTP {status_code}"
+    if isinstance(error, CircuitOpenError):
+        return "upstream unavailable"
+    if isinstance(error, requests.Timeout) or (httpx is not None and isinstance(error, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(error, requests.ConnectionError) or (httpx is not None and isinstance(error, httpx.TransportError)):
+        return "connection error"
+    return "unexpected response"
+
+
+def record_failure(label: str, category: str):
+    """
+    Records in the current run that an item could not be retrieved, replacing any earlier category for it.
+
+    :param label: how the item is listed in the run report
+    :param category: failure category from classify_failure
+    """
+    run_statistics = _run_statistics.get()
+    if run_statistics is not None:
+        with _run_statistics_lock:
+            run_statistics["failures"][label] = category
+
+
+def recall_stale(kind: str, key: str, label: str = None):
+    """
+    Returns the last known good data for an item whose upstream request failed, and records in the current
+    run that the item was served stale.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key: normalized identifier of the item
+    :param label: how the item is listed in the run report, defaults to key
+    :return: last known good data, or None if there is none
+    """
+    with _last_known_good_lock:
+        data = _last_known_good.get((kind, key))
+    if data is not None:
+        record_stale(label or key)
+    return data
+
+
+def hedge_threshold(host: str):
+    """
+    Returns how long to wait for a request to a host before sending a hedged copy.
+
+    :param host: host name
+    :return: seconds, or None if there are too few recent requests to the host to tell
+    """
+    with _recent_latencies_lock:
+        recent_latencies = list(_recent_latencies[host])
+    if len(recent_latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return percentile(recent_latencies, HEDGE_PERCENTILE)
+
+
+class RateController:
+    """
+    Schedules request start times for one host, shared by every session in the process. No more than the
+    allowed number of requests per interval are started; the allowed rate follows the server's rate-limit
+    headers, is halved whenever the server answers 429, and grows back gradually after successful requests.
+
+    Waiting requests are queued per session and slots are handed out round robin between sessions, with
+    interactive sessions served before bulk ones, so each active session gets an equal share of the budget.
+    """
+    def __init__(self, limit: float, interval: float):
+        self.limit = limit
+        self.interval = interval
+        self.current_limit = limit
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.next_request_time = time.monotonic()
+        self.waiting = OrderedDict()  # session id -> deque of queued request tickets, in round-robin order
+        self.interactive_sessions = set()
+
+    def next_session(self):
+        """
+        Picks the session whose request goes next: the first interactive session in round-robin order, or
+        the first session if none is interactive. Must be called with the lock held.
+
+        :return: session id
+        """
+        for session_id in self.waiting:
+            if session_id in self.interactive_sessions:
+                return session_id
+        return next(iter(self.waiting))
+
+    def wait(self):
+        """
+        Blocks until the caller is allowed to start its request.
+        """
+        session_id, interactive = _request_context.get()
+        ticket = object()
+        with self.condition:
+            session_queue = self.waiting.setdefault(session_id, deque())
+            session_queue.append(ticket)
+            if interactive:
+                self.interactive_sessions.add(session_id)
+            self.condition.notify_all()
+
+            while True:
+                if self.next_session() != session_id or session_queue[0] is not ticket:
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                if now < self.next_request_time:
+                    self.condition.wait(self.next_request_time - now)
+                    continue
+
+                session_queue.popleft()
+                if session_queue:
+                    self.waiting.move_to_end(session_id)
+                else:
+                    del self.waiting[session_id]
+                    self.interactive_sessions.discard(session_id)
+                self.next_request_time = now + self.interval / self.current_limit
+                self.condition.notify_all()
+                return
+
+    def update_from_headers(self, headers):
+        """
+        Adopts the budget announced in X-Rate-Limit-Limit and X-Rate-Limit-Interval (e.g. "50" and "1s").
+
+        :param headers: response headers
+        """
+        limit = headers.get("X-Rate-Limit-Limit")
+        interval = headers.get("X-Rate-Limit-Interval")
+        if not limit or not interval:
+            return
+        interval_match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*", interval)
+        try:
+            limit = float(limit)
+        except ValueError:
+            return
+        if not interval_match or limit <= 0:
+            return
+        interval = float(interval_match.group(1)) * {"ms": 0.001, None: 1, "s": 1, "m": 60, "h": 3600}[
+            interval_match.group(2)]
+        if interval <= 0:
+            return
+        with self.lock:
+            if (limit, interval) != (self.limit, self.interval):
+                self.current_limit = min(self.current_limit / self.interval * interval, limit)
+                self.limit = limit
+                self.interval = interval
+
+    def record_success(self):
+        """
+        Gradually restores the rate after it was reduced by a 429 response.
+        """
+        with self.lock:
+            if self.current_limit < self.limit:
+                self.current_limit = min(self.limit, self.current_limit + self.limit / 50)
+
+    def record_throttled(self, retry_after: float = None):
+        """
+        Halves the rate and, if the server sent Retry-After, holds back all requests to the host until then.
+
+        :param retry_after: seconds the server asked us to wait
+        """
+        with self.condition:
+            self.current_limit = max(self.current_limit / 2, self.limit / 50)
+            if retry_after:
+                self.next_request_time = max(self.next_request_time, time.monotonic() + retry_after)
+            self.condition.notify_all()
+
+
+_rate_controllers = {}
+_rate_controllers_lock = threading.Lock()
+
+
+def get_rate_controller(host: str):
+    """
+    Returns the rate controller for a host, creating it with the host's starting budget on first use.
+
+    :param host: host name, e.g. "api.crossref.org"
+    :return: RateController
+    """
+    with _rate_controllers_lock:
+        if host not in _rate_controllers:
+            _rate_controllers[host] = RateController(*HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        return _rate_controllers[host]
+
+
+class CircuitBreaker:
+    """
+    Tracks the error rate of recent requests to one host. Once it crosses the threshold the circuit opens and
+    requests fail fast; after a cool-down one probe request is let through, which closes the circuit again
+    if it succeeds and reopens it if it fails.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outcomes = deque(maxlen=CIRCUIT_WINDOW)
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def allow_request(self):
+        """
+        :return: whether a request may be sent to the host, and whether it is the probe of an open circuit
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True, False
+            if self.probe_in_flight or time.monotonic() - self.opened_at < CIRCUIT_RESET_TIMEOUT:
+                return False, False
+            self.probe_in_flight = True
+            return True, True
+
+    def record_success(self):
+        """
+        Records a request that got an answer from the host.
+        """
+        with self.lock:
+            self.outcomes.append(True)
+            if self.opened_at is not None and self.probe_in_flight:
+                self.opened_at = None
+                self.probe_in_flight = False
+                self.outcomes.clear()
+
+    def record_failure(self):
+        """
+        Records a failed request, opening the circuit if the error rate crosses the threshold.
+        """
+        with self.lock:
+            self.outcomes.append(False)
+            if self.opened_at is not None:
+                if self.probe_in_flight:
+                    self.opened_at = time.monotonic()
+                    self.probe_in_flight = False
+                return
+            error_count = self.outcomes.count(False)
+            if (len(self.outcomes) >= CIRCUIT_MIN_REQUESTS
+                    and error_count / len(self.outcomes) >= CIRCUIT_ERROR_THRESHOLD):
+                self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """
+        Lets another probe through after a probe request that ended without an answer from the host either way.
+        """
+        with self.lock:
+            self.probe_in_flight = False
+
+    def is_open(self):
+        """
+        :return: True while requests to the host fail fast
+        """
+        with self.lock:
+            return self.opened_at is not None
+
+
+def get_circuit_breaker(host: str):
+    """
+    Returns the circuit breaker for a host, creating it on first use.
+
+    :param host: host name, e.g. "data.crossref.org"
+    :return: CircuitBreaker
+    """
+    with _circuit_breakers_lock:
+        if host not in _circuit_breakers:
+            _circuit_breakers[host] = CircuitBreaker()
+        return _circuit_breakers[host]
+
+
+def parse_retry_after(headers):
+    """
+    Reads a Retry-After header given in seconds.
+
+    :param headers: response headers
+    :return: seconds to wait, or None
+    """
+    try:
+        return max(0.0, float(headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int):
+    """
+    Exponential backoff with full jitter, so that concurrent workers do not retry in lock step.
+
+    :param attempt: number of the failed attempt, starting at 0
+    :return: seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def create_http_client():
+    """
+    Creates a client with keep-alive connection pools per host and compressed transfer encoding. Uses an
+    HTTP/2 capable httpx client when available, otherwise a requests session.
+
+    :return: httpx.Client or requests.Session
+    """
+    accept_encoding = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+    headers = {"User-Agent": USER_AGENT, "Accept-Encoding": accept_encoding}
+
+    if USE_HTTP2 and httpx is not None:
+        return httpx.Client(http2=True,
+                            headers=headers,
+                            follow_redirects=True,
+                            limits=httpx.Limits(max_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+                                                max_keepalive_connections=POOL_CONNECTIONS * POOL_MAXSIZE))
+
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_http_client():
+    """
+    Returns the process-wide HTTP client, creating it on first use.
+
+    :return: httpx.Client or requests.Session
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = create_http_client()
+    return _client
+
+
+def send_request(host: str, url: str, params: dict = None, headers: dict = None, admitted: threading.Event = None):
+    """
+    Sends a single GET request once the host's rate controller allows it, with connect and read deadlines.
+
+    :param host: host name of the URL
+    :param url: URL to request
+    :param params: query string parameters
+    :param headers: additional request headers
+    :param admitted: optional event that is set once the rate controller has let the request through
+    :return: response object
+    """
+    get_rate_controller(host).wait()
+    if admitted is not None:
+        admitted.set()
+    client = get_http_client()
+    if isinstance(client, requests.Session):
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    else:
+        timeout = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+    count_in_run("upstream requests")
+    start_time = time.perf_counter()
+    try:
+        response = client.get(url, params=params, headers=headers, timeout=timeout)
+    except Exception:
+        with _statistics_lock:
+            _statistics[host]["requests"] += 1
+            _statistics[host]["errors"] += 1
+        raise
+    record_latency(host, time.perf_counter() - start_time)
+    with _statistics_lock:
+        _statistics[host]["requests"] += 1
+        _statistics[host]["bytes"] += len(response.content)
+    return response
+
+
+def send_hedged_request(host: str, url: str, params: dict = None, headers: dict = None):
+    """
+    Sends a GET request and, if it is still outstanding the host's recent p95 latency after the rate controller
+    let it through, sends a second identical request. Time spent queueing for the host's budget does not count,
+    otherwise every request to a saturated host would be hedged. Whichever successful answer arrives first is
+    returned.
+
+    :param host: host name of the URL
+    :param url: URL to request
+    :param params: query string parameters
+    :param headers: additional request headers
+    :return: response object
+    """
+    threshold = hedge_threshold(host)
+    send = run_in_request_context(send_request)
+    admitted = threading.Event()
+    first_future = _hedge_executor.submit(send, host, url, params, headers, admitted)
+    if threshold is None:
+        return first_future.result()
+
+    # Also wakes up if the request fails before it is admitted.
+    first_future.add_done_callback(lambda future: admitted.set())
+    admitted.wait()
+    done, _ = wait([first_future], timeout=threshold)
+    if done:
+        return first_future.result()
+
+    pending = {first_future, _hedge_executor.submit(send, host, url, params, headers)}
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+        if not pending:
+            return done.pop().result()
+
+
+def http_get(url: str, params: dict = None, headers: dict = None, hedge: bool = False):
+    """
+    Sends a GET request through the shared client so that connections to each host are reused. If an identical
+    request (same URL, parameters and headers) is already in flight in this process, for any session, waits
+    for its result instead of sending a duplicate.
+
+    :param url: URL to request
+    :param params: query string parameters
+    :param headers: additional request headers
+    :param hedge: send a second copy of the request if the first is slower than the host's recent p95
+    :return: response object with status_code, headers, content and json(); the last response if retries ran out
+    """
+    request_key = (url,
+                   tuple(sorted((str(key), str(value)) for key, value in (params or {}).items())),
+                   tuple(sorted((str(key), str(value)) for key, value in (headers or {}).items())))
+    with _in_flight_lock:
+        future = _in_flight.get(request_key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _in_flight[request_key] = future
+
+    if not is_leader:
+        with _statistics_lock:
+            _statistics[urllib.parse.urlsplit(url).netloc]["coalesced"] += 1
+        return future.result()
+
+    try:
+        response = http_get_with_retries(url, params, headers, hedge)
+    except BaseException as error:
+        future.set_exception(error)
+        raise
+    else:
+        future.set_result(response)
+        return response
+    finally:
+        with _in_flight_lock:
+            del _in_flight[request_key]
+
+
+def http_get_with_retries(url: str, params: dict = None, headers: dict = None, hedge: bool = False):
+    """
+    Sends a GET request, scheduled by the host's rate controller and given connect/read deadlines. 429/5xx
+    responses, timeouts and connection errors are retried with jittered exponential backoff; other exceptions
+    are raised at once. While the host's circuit breaker is open, CircuitOpenError is raised without sending
+    anything.
+
+    :param url: URL to request
+    :param params: query string parameters
+    :param headers: additional request headers
+    :param hedge: send a second copy of the request if the first is slower than the host's recent p95
+    :return: response object with status_code, headers, content and json(); the last response if retries ran out
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    rate_controller = get_rate_controller(host)
+    circuit_breaker = get_circuit_breaker(host)
+    allowed, is_probe = circuit_breaker.allow_request()
+    if not allowed:
+        raise CircuitOpenError(f"Circuit breaker for {host} is open")
+
+    # The breaker gets one outcome per request, once its retries are used up, so that a few identifiers that
+    # keep failing cannot open the circuit for every other request to the host.
+    attempt = 0
+    while True:
+        if attempt and not is_probe and circuit_breaker.is_open():
+            raise CircuitOpenError(f"Circuit breaker for {host} is open")
+        try:
+            if hedge:
+                response = send_hedged_request(host, url, params, headers)
+            else:
+                response = send_request(host, url, params, headers)
+        except RETRY_EXCEPTIONS:
+            if attempt >= MAX_RETRIES:
+                circuit_breaker.record_failure()
+                raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        except Exception:
+            if is_probe:
+                circuit_breaker.release_probe()
+            raise
+
+        rate_controller.update_from_headers(response.headers)
+        if response.status_code not in RETRY_STATUS_CODES:
+            circuit_breaker.record_success()
+            rate_controller.record_success()
+            return response
+
+        with _statistics_lock:
+            _statistics[host]["errors"] += 1
+        retry_after = parse_retry_after(response.headers)
+        if response.status_code == 429:
+            rate_controller.record_throttled(retry_after)
+        if attempt >= MAX_RETRIES:
+            if response.status_code != 429:  # Throttling is handled by the rate controller, not the breaker.
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+            return response
+        time.sleep(max(retry_after or 0, backoff_delay(attempt)))
+        attempt += 1
+
+
+def pool_statistics():
+    """
+    Summarises use of the shared client per host: requests sent, failed requests, bytes received (after
+    decompression), calls answered by an identical request already in flight and, for the requests backend,
+    how many connections were opened. Far fewer connections than requests means keep-alive is working.
+
+    :return: dictionary of host to statistics dictionary
+    """
+    with _statistics_lock:
+        statistics = {host: dict(host_statistics) for host, host_statistics in _statistics.items()}
+
+    client = _client
+    if isinstance(client, requests.Session):
+        for adapter in set(client.adapters.values()):
+            for pool_key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[pool_key]
+                host = pool.host if pool.port in (None, 80, 443) else f"{pool.host}:{pool.port}"
+                host_statistics = statistics.setdefault(host, {"requests": 0, "errors": 0, "bytes": 0,
+                                                               "coalesced": 0})
+                host_statistics["connections_opened"] = (host_statistics.get("connections_opened", 0)
+                                                         + pool.num_connections)
+    return statistics
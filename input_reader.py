@@ -0,0 +1,104 @@
+import gzip
+import io
+import itertools
+import mmap
+import re
+import zipfile
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZIP_MAGIC = b"PK\x03\x04"
+READ_CHUNK_SIZE = 1024 * 1024  # Bytes decompressed at a time from gzip and zip uploads.
+
+# DOIs end at whitespace or at the delimiters of RIS, BibTeX, CSV and MEDLINE fields; DOIs that themselves contain
+# a comma or semicolon are cut there.
+IDENTIFIER_PATTERN = re.compile(r'(?P<doi>\b10\.\d{4,9}/[^\s"<>{},;]+)|(?P<nctid>\bNCT\d{8}\b)', re.IGNORECASE)
+# Web of Science cited references (tagged "CR" or BibTeX "Cited-References"), continued on indented lines.
+CITED_REFERENCES_PATTERN = re.compile(r'CR |\s*cited-references\s*=', re.IGNORECASE)
+
+
+def read_lines(binary_file):
+    """
+    Yields the lines of a binary file object one at a time, decoded as UTF-8 (a byte order mark is dropped,
+    undecodable bytes are replaced) and without "\\n" or "\\r\\n" line endings.
+
+    :param binary_file: file object opened in binary mode, or an mmap
+    :return: generator of lines
+    """
+    first_line = True
+    for line in iter(binary_file.readline, b""):
+        if first_line:
+            line = line.removeprefix(b"\xef\xbb\xbf")
+            first_line = False
+        yield line.rstrip(b"\r\n").decode("utf-8", errors="replace")
+
+
+def read_identifiers(filename: str):
+    """
+    Streams the lines of an identifier file without reading it into memory. Plain text files are memory-mapped,
+    gzip files are decompressed and zip archives are read member by member, each in chunks of READ_CHUNK_SIZE.
+    Files are recognised by their first bytes, not their name, since uploads are stored under a temporary name.
+
+    :param filename: path to a text, .gz or .zip file with one identifier per line
+    :return: generator of lines
+    """
+    with open(filename, "rb") as file:
+        magic = file.read(len(ZIP_MAGIC))
+        file.seek(0)
+
+        if magic.startswith(GZIP_MAGIC):
+            with gzip.GzipFile(fileobj=file) as gzip_file:
+                yield from read_lines(io.BufferedReader(gzip_file, READ_CHUNK_SIZE))
+        elif magic == ZIP_MAGIC:
+            with zipfile.ZipFile(file) as archive:
+                for member in archive.infolist():
+                    if not member.is_dir():
+                        with archive.open(member) as member_file:
+                            yield from read_lines(io.BufferedReader(member_file, READ_CHUNK_SIZE))
+        elif magic:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                yield from read_lines(mapped_file)
+
+
+def iterate_chunks(iterable, chunk_size: int):
+    """
+    Groups the items of an iterable into lists of chunk_size items (the last one may be shorter), reading the
+    iterable only as far as the chunk being built.
+
+    :param iterable: any iterable, e.g. the generator returned by read_identifiers
+    :param chunk_size: maximum number of items per chunk
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, chunk_size)):
+        yield chunk
+
+
+def extract_identifiers(filename: str, doi: bool = True, nctid: bool = True):
+    """
+    Streams the DOIs and NCTIDs found anywhere in a bibliographic export (RIS, BibTeX, CSV, MEDLINE or Web of
+    Science, also gzipped or zipped), in the order they appear, with a single pass of IDENTIFIER_PATTERN over
+    each line. The DOIs of cited references in Web of Science exports are skipped, since they are not the
+    exported works. Only one line is held in memory at a time.
+
+    :param filename: path to the export file
+    :param doi: yield DOIs, in format "10.XXX/XXXX"
+    :param nctid: yield NCTIDs, in format "NCT########"
+    :return: generator of identifiers, not deduplicated
+    """
+    in_cited_references = False
+    for line in read_identifiers(filename):
+        if CITED_REFERENCES_PATTERN.match(line) or (in_cited_references and line[:1].isspace()):
+            # A BibTeX field ends with its closing brace, a tagged field at the next tag.
+            in_cited_references = not line.rstrip().endswith(("}", "},"))
+            continue
+        in_cited_references = False
+
+        for match in IDENTIFIER_PATTERN.finditer(line):
+            if match.lastgroup == "doi" and doi:
+                identifier = match.group("doi").rstrip(".")
+                # Keep a closing parenthesis that is part of the DOI, e.g. 10.1016/S0140-6736(20)30183-5.
+                while identifier.endswith(")") and identifier.count(")") > identifier.count("("):
+                    identifier = identifier[:-1].rstrip(".")
+                yield identifier
+            elif match.lastgroup == "nctid" and nctid:
+                yield match.group("nctid")
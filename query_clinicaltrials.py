@@ -1,57 +1,258 @@
+import itertools
 import string
 import time
-import requests
 import re
 import numpy as np
 import pandas as pd
 from collections import Counter, OrderedDict
 from matplotlib import pyplot as plt, ticker
 
+from http_client import (http_get, json_loads, record_run, latency_report, remember_good, classify_failure,
+                         record_failure, PERMANENT_FAILURE_CATEGORIES, RETRY_PASS_DELAY)
+from clinicaltrials_bulk_data import clinicaltrials_bulk_data_lookup
+from input_reader import read_identifiers, extract_identifiers, iterate_chunks
+from result_cache import (fetch_cached_json, cache_get_fresh_many, cache_get_failures_many, cache_put,
+                          cache_put_failure, recall_cached_stale)
+
 def clinicaltrials_read_input_file(filename: str):
     """
-    Reads an input text file and returns it as a list.
+    Reads an input file (plain text, gzip or zip) line by line, see input_reader.read_identifiers.
 
     :param filename: path to the input file
-    :return: file contents as a list
+    :return: generator of lines
+    """
+    return read_identifiers(filename)
+
+
+def clinicaltrials_read_export_file(filename: str):
+    """
+    Reads the NCTIDs out of a bibliographic export (RIS, BibTeX, CSV, MEDLINE), see input_reader.extract_identifiers.
+
+    :param filename: path to the export file
+    :return: generator of NCTIDs
+    """
+    return extract_identifiers(filename, doi=False)
+
+
+CLINICALTRIALS_NCTID_PATTERN = re.compile(r'(?:NCTID:\s*)?NCT[\s-]?0*(\d{1,8})', re.IGNORECASE)
+
+
+def clinicaltrials_normalize_nctid(item: str):
     """
-    print(filename)
-    file = open(filename, "r")
-    input_data = file.read()
-    input_list = input_data.split("\n")
-    file.close()
-    return input_list
+    Brings an NCTID in any of the formats clinicaltrials_clean_input_list accepts into format "NCT########".
+
+    :param item: possible NCTID, e.g. "nct123", "NCT 00000123", "nct-00000123" or "NCTID: NCT00000123"
+    :return: NCTID in format "NCT########", or None if the item is not an NCTID
+    """
+    nctid_match = CLINICALTRIALS_NCTID_PATTERN.fullmatch(item.strip())
+    return f"NCT{nctid_match.group(1).zfill(8)}" if nctid_match else None
 
 
 def clinicaltrials_clean_input_list(input_list: list):
     """
-    Cleans common errors in input list to get NCTIDs in format "NCT########" or "nct########",
-    removing duplicates.
+    Cleans common errors in input list to get NCTIDs in format "NCT########", removing duplicates. NCTIDs are
+    case-insensitive and missing or extra leading zeros are corrected, so "nct123" and "NCTID: NCT00000123"
+    both become "NCT00000123". Other items are passed on unchanged.
 
-    :param input_list: list of NCTIDs
-    :return: cleaned list of NCTIDs
+    :param input_list: list (or any iterable, e.g. clinicaltrials_read_input_file) of NCTIDs
+    :return: generator of cleaned NCTIDs, in input order
     """
-    cleaned_input_list = []
+    seen_item_set = set()
     for item in input_list:
-        if item == '':
-            continue
-        elif re.search(r'^[Nn][Cc][Tt]0*[1-9]\d{0,7}$', item):
-            search_item = item
-        elif re.search(r'^NCTID: ', item):
-            new_item = re.sub(r'NCTID: ', '', item, 1)
-            search_item = new_item
-        else:
-            search_item = item
-        cleaned_input_list.append(search_item.strip())
-        cleaned_input_list = list(set(cleaned_input_list))
-    return cleaned_input_list
+        search_item = clinicaltrials_normalize_nctid(item) or item.strip()
+        if search_item and search_item.upper() not in seen_item_set:
+            seen_item_set.add(search_item.upper())
+            yield search_item
+
+
+def clinicaltrials_project_study(protocol_section: dict):
+    """
+    Keeps only the part of a study's protocol section that this app uses.
+
+    :param protocol_section: protocolSection of a study
+    :return: protocol section with only the sponsor/collaborator module (if the study has one)
+    """
+    return {key: value for key, value in protocol_section.items() if key == "sponsorCollaboratorsModule"}
+
+
+def clinicaltrials_fetch_study(identifier: str, hedge: bool = False):
+    """
+    Retrieves the sponsor/collaborator module of a single study from ClinicalTrials.gov, from the result cache
+    when it holds a fresh copy. If ClinicalTrials.gov cannot be reached, the last known good sponsor information
+    for the study is returned instead and reported as stale.
+
+    :param identifier: NCTID in format "NCT########"
+    :param hedge: send a second request if the first is slower than recent ClinicalTrials.gov requests
+    :return: protocol section of the study with only the sponsor/collaborator module, or None if the query failed
+    """
+    work_url = f'https://clinicaltrials.gov/api/v2/studies/{identifier}'
+    return fetch_cached_json("clinicaltrials-study", identifier.upper(), work_url,
+                             extract=lambda result: clinicaltrials_project_study(result['protocolSection']),
+                             hedge=hedge, label=identifier)
+
+
+def clinicaltrials_normalize_sponsors(sponsor_and_collaborator_info: dict):
+    """
+    Extracts lead sponsor and collaborator names and classes from the sponsor/collaborator module of one study.
+
+    :param sponsor_and_collaborator_info: sponsorCollaboratorsModule of a study
+    :return: lead sponsor name, lead sponsor class, list of collaborator names and list of collaborator
+    classes (['NA'] if the study has no collaborators)
+    """
+    lead_sponsor = sponsor_and_collaborator_info['leadSponsor']['name']
+    lead_sponsor_class = sponsor_and_collaborator_info['leadSponsor']['class']
+
+    if 'collaborators' in sponsor_and_collaborator_info:
+        collaborator_list = []
+        collaborator_class_list = []
+        for item in sponsor_and_collaborator_info['collaborators']:
+            collaborator_list.append(item['name'])
+            collaborator_class_list.append(item['class'])
+    else:
+        collaborator_list = ['NA']
+        collaborator_class_list = ['NA']
+
+    return lead_sponsor, lead_sponsor_class, collaborator_list, collaborator_class_list
+
+
+CLINICALTRIALS_BATCH_SIZE = 250  # NCTIDs per request, keeps the filter.ids URL around 3,000 characters.
+CLINICALTRIALS_STREAM_CHUNK_SIZE = 1000  # NCTIDs looked up in the bulk data index at a time.
+CLINICALTRIALS_PAGE_SIZE = 1000  # Maximum page size of the ClinicalTrials.gov API.
+CLINICALTRIALS_PROJECTION_FIELDS = ("protocolSection.identificationModule.nctId,"
+                                    "protocolSection.sponsorCollaboratorsModule")
+
+
+def clinicaltrials_fetch_study_batch(identifier_batch: list, hedge: bool = False):
+    """
+    Retrieves the sponsor/collaborator module for several studies with the list endpoint, following
+    nextPageToken until every page has been read.
+
+    :param identifier_batch: list of NCTIDs in format "NCT########"
+    :param hedge: send a second request if the first is slower than recent ClinicalTrials.gov requests
+    :return: dictionary of NCTID to protocol section (only the sponsor/collaborator module), with None for
+    NCTIDs ClinicalTrials.gov did not return. If a request failed, the cached or last known good data is used
+    for NCTIDs that have it. NCTIDs left without data are recorded as failures; NCTIDs missing from a
+    successful answer are remembered as not found.
+    """
+    protocol_section_dictionary = dict.fromkeys(identifier_batch)
+    identifier_lookup = {identifier.upper(): identifier for identifier in identifier_batch}
+    params = {"filter.ids": ",".join(identifier_lookup),
+              "fields": CLINICALTRIALS_PROJECTION_FIELDS,
+              "pageSize": CLINICALTRIALS_PAGE_SIZE}
+    try:
+        while True:
+            response = http_get("https://clinicaltrials.gov/api/v2/studies", params=params, hedge=hedge)
+            response.raise_for_status()
+            result = json_loads(response.content)
+            for study in result['studies']:
+                protocol_section = study['protocolSection']
+                identifier = identifier_lookup.get(protocol_section['identificationModule']['nctId'].upper())
+                if identifier is not None:
+                    protocol_section_dictionary[identifier] = clinicaltrials_project_study(protocol_section)
+                    remember_good("clinicaltrials-study", identifier.upper(),
+                                  protocol_section_dictionary[identifier])
+                    cache_put("clinicaltrials-study", identifier.upper(), protocol_section_dictionary[identifier])
+            if not result.get('nextPageToken'):
+                break
+            params = dict(params, pageToken=result['nextPageToken'])
+    except Exception as error:
+        category = classify_failure(error)
+        if category in PERMANENT_FAILURE_CATEGORIES and len(identifier_batch) > 1:
+            # One bad NCTID can get the whole request rejected, the retry pass looks each NCTID up on its own.
+            category = "batch rejected"
+        for identifier, protocol_section in protocol_section_dictionary.items():
+            if protocol_section is None:
+                protocol_section_dictionary[identifier] = recall_cached_stale("clinicaltrials-study",
+                                                                              identifier.upper(), identifier)
+                if protocol_section_dictionary[identifier] is None:
+                    record_failure(identifier, category)
+        return protocol_section_dictionary
+
+    for identifier, protocol_section in protocol_section_dictionary.items():
+        if protocol_section is None:
+            record_failure(identifier, "not found")
+            cache_put_failure("clinicaltrials-study", identifier.upper(), "not found")
+    return protocol_section_dictionary
+
+
+def clinicaltrials_fetch_studies_batched(cleaned_input_list: list, hedge: bool = False):
+    """
+    Retrieves the sponsor/collaborator module for a list of studies, CLINICALTRIALS_BATCH_SIZE NCTIDs per request.
+    Studies with a fresh entry in the result cache, or remembered as not found, are not requested.
+
+    :param cleaned_input_list: input list (or generator) of NCTIDs in format "NCT########"
+    :param hedge: send a second request if the first is slower than recent ClinicalTrials.gov requests
+    :return: generator of (NCTID, protocol section or None) pairs, in input order
+    """
+    for identifier_batch in iterate_chunks(cleaned_input_list, CLINICALTRIALS_BATCH_SIZE):
+        cached_dictionary = cache_get_fresh_many("clinicaltrials-study",
+                                                 [identifier.upper() for identifier in identifier_batch])
+        missing_identifier_list = [identifier for identifier in identifier_batch
+                                   if identifier.upper() not in cached_dictionary]
+        failure_dictionary = cache_get_failures_many("clinicaltrials-study",
+                                                     [identifier.upper() for identifier in missing_identifier_list],
+                                                     missing_identifier_list)
+        missing_identifier_list = [identifier for identifier in missing_identifier_list
+                                   if identifier.upper() not in failure_dictionary]
+        fetched_dictionary = clinicaltrials_fetch_study_batch(missing_identifier_list, hedge) \
+            if missing_identifier_list else {}
+        for identifier in identifier_batch:
+            if identifier.upper() in cached_dictionary:
+                yield identifier, cached_dictionary[identifier.upper()]
+            else:
+                yield identifier, fetched_dictionary.get(identifier)
+
+
+def clinicaltrials_prepare_identifiers(cleaned_input_list, indexed_dictionary: dict):
+    """
+    Reads NCTIDs CLINICALTRIALS_STREAM_CHUNK_SIZE at a time, puts those found in the bulk data index in
+    indexed_dictionary and yields the others, so the fetchers can start while the input is still being read.
+
+    :param cleaned_input_list: input list (or generator) of NCTIDs in format "NCT########"
+    :param indexed_dictionary: dictionary that is filled with NCTID to protocol section for indexed studies
+    :return: generator of NCTIDs to query at ClinicalTrials.gov
+    """
+    for identifier_chunk in iterate_chunks(cleaned_input_list, CLINICALTRIALS_STREAM_CHUNK_SIZE):
+        chunk_indexed_dictionary = clinicaltrials_bulk_data_lookup(identifier_chunk)
+        indexed_dictionary.update(chunk_indexed_dictionary)
+        yield from (identifier for identifier in identifier_chunk if identifier not in chunk_indexed_dictionary)
+
+
+def clinicaltrials_retry_studies(retry_identifier_list: list, hedge: bool = False):
+    """
+    Looks up, one at a time and after RETRY_PASS_DELAY, the studies whose first lookup failed transiently.
+    The list is only read once the generator is first advanced, so it can still be filled while the first
+    pass streams.
+
+    :param retry_identifier_list: list of NCTIDs to retry
+    :param hedge: send a second request if the first is slower than recent ClinicalTrials.gov requests
+    :return: generator of (NCTID, protocol section or None) pairs
+    """
+    if retry_identifier_list:
+        time.sleep(RETRY_PASS_DELAY)
+    for identifier in retry_identifier_list:
+        yield identifier, clinicaltrials_fetch_study(identifier, hedge)
 
 
-def query_clinicaltrials(cleaned_input_list: list):
+def query_clinicaltrials(cleaned_input_list: list, hedge: bool = False, run_report: dict = None,
+                         batch_lookup: bool = False, use_bulk_data_index: bool = False):
     """
     Queries ClinicalTrials.gov for funders of items with specific NCTIDs. See ClinicalTrials.gov documentation for more
     details: https://clinicaltrials.gov/data-api/api
 
-    :param cleaned_input_list: input list of NCTIDs in format "NCT########" or "nct########"
+    Studies are normalized one at a time as they arrive, so run time grows linearly with the number of NCTIDs
+    and only the results, not the downloaded study records, are kept.
+
+    :param cleaned_input_list: input list of NCTIDs in format "NCT########" or "nct########", or a generator such
+    as clinicaltrials_clean_input_list(clinicaltrials_read_input_file(...)), which is read as the studies are fetched
+    :param hedge: send a second request for NCTIDs whose first request is slower than the recent p95
+    :param batch_lookup: fetch many NCTIDs per request from the list endpoint, downloading only the
+    sponsor/collaborator module of each study
+    :param run_report: optional dictionary that is filled with statistics about the run: latency per host,
+    the studies that were served from last known good data because ClinicalTrials.gov failed, and the failure
+    category of each NCTID with an error. NCTIDs that failed transiently are retried once at the end.
+    :param use_bulk_data_index: answer from the index built by clinicaltrials_bulk_data.py first and only query
+    the API for NCTIDs that are not in it (e.g. registered after the download)
     :return: list of dictionaries with attributes from returned queries in ClinicalTrials.gov
     """
     identifier_with_error_list = []
@@ -63,54 +264,69 @@ def query_clinicaltrials(cleaned_input_list: list):
     all_collaborators_dictionary = {}
     collaborator_class_dictionary = {}
 
-    for identifier in cleaned_input_list:
-        try:
-            work_url = f'https://clinicaltrials.gov/api/v2/studies/{identifier}'
-            response = requests.get(work_url)
-            result = response.json()
-            protocol_section = result['protocolSection']
+    with record_run() as run_statistics:
+        indexed_dictionary = {}
+        if use_bulk_data_index:
+            cleaned_input_list = clinicaltrials_prepare_identifiers(cleaned_input_list, indexed_dictionary)
 
-            if "sponsorCollaboratorsModule" in protocol_section:
-                bottom_level_funder_dictionary[identifier] = protocol_section['sponsorCollaboratorsModule']
-            else:
+        if batch_lookup:
+            protocol_sections = clinicaltrials_fetch_studies_batched(cleaned_input_list, hedge)
+        else:
+            protocol_sections = ((identifier, clinicaltrials_fetch_study(identifier, hedge))
+                                 for identifier in cleaned_input_list)
+        # chain only reads indexed_dictionary once the API stream, and so the input, is exhausted.
+        protocol_sections = itertools.chain(protocol_sections, indexed_dictionary.items())
+
+        retry_identifier_list = []
+        for identifier, protocol_section in itertools.chain(protocol_sections,
+                                                            clinicaltrials_retry_studies(retry_identifier_list, hedge)):
+            if protocol_section is None:
+                if identifier not in retry_identifier_list \
+                        and run_statistics["failures"].get(identifier) not in PERMANENT_FAILURE_CATEGORIES:
+                    retry_identifier_list.append(identifier)
+                else:
+                    identifier_with_error_list.append(identifier)
+                continue
+
+            if "sponsorCollaboratorsModule" not in protocol_section:
                 identifier_with_no_funder_list.append(identifier)
-            time.sleep(0.02)  # Could not find a given request limit on ClinicalTrials.gov.
-
-        except Exception:
-            identifier_with_error_list.append(identifier)
-            continue
-
-        for original_work, sponsor_and_collaborator_info in bottom_level_funder_dictionary.items():
-            lead_sponsor = sponsor_and_collaborator_info['leadSponsor']['name']
-            lead_sponsor_class = sponsor_and_collaborator_info['leadSponsor']['class']
-            lead_sponsor_dictionary[identifier] = lead_sponsor
-            lead_sponsor_class_dictionary[identifier] = lead_sponsor_class
-
-            if 'collaborators' in sponsor_and_collaborator_info:
-                collaborator_list_of_dictionaries = sponsor_and_collaborator_info['collaborators']
-                collaborator_temp_list = []
-                collaborator_class_temp_list = []
-                for item in collaborator_list_of_dictionaries:
-                    collaborator = item['name']
-                    collaborator_temp_list.append(collaborator)
-
-                    collaborator_class = item['class']
-                    collaborator_class_temp_list.append(collaborator_class)
-
-                all_collaborators_dictionary[identifier] = collaborator_temp_list
-                collaborator_class_dictionary[identifier] = collaborator_class_temp_list
-            else:
-                all_collaborators_dictionary[identifier] = ['NA']
-                collaborator_class_dictionary[identifier] = ['NA']
+                continue
+
+            bottom_level_funder_dictionary[identifier] = protocol_section['sponsorCollaboratorsModule']
+
+            (lead_sponsor_dictionary[identifier],
+             lead_sponsor_class_dictionary[identifier],
+             all_collaborators_dictionary[identifier],
+             collaborator_class_dictionary[identifier]) \
+                = clinicaltrials_normalize_sponsors(protocol_section['sponsorCollaboratorsModule'])
 
+    identifier_failure_dictionary = {identifier: run_statistics["failures"].get(identifier, "unexpected response")
+                                     for identifier in identifier_with_error_list}
 
     print(f"error: {identifier_with_error_list}")
+    print(f"failure categories: {identifier_failure_dictionary}")
+    print(f"retried: {retry_identifier_list}")
+    print(f"answered from bulk data index: {len(indexed_dictionary)}")
     print(f"no funder: {identifier_with_no_funder_list}")
     print(f"bottom level funder: {bottom_level_funder_dictionary}")
     print(f"lead sponsor: {lead_sponsor_dictionary}")
     print(f"lead sponsor class: {lead_sponsor_class_dictionary}")
     print(f"all collaborators: {all_collaborators_dictionary}")
     print(f"collaborator class: {collaborator_class_dictionary}")
+    print(f"latency: {latency_report(run_statistics['latency'])}")
+    print(f"stale: {run_statistics['stale']}")
+    print(f"cache: {dict(run_statistics['counts'])}")
+
+    if run_report is not None:
+        run_report["latency"] = latency_report(run_statistics["latency"])
+        run_report["stale"] = run_statistics["stale"]
+        run_report["failures"] = identifier_failure_dictionary
+        run_report["retried"] = len(retry_identifier_list)
+        run_report["index_hits"] = len(indexed_dictionary)
+        run_report["cache"] = {"hits": run_statistics["counts"]["cache hits"],
+                               "misses": run_statistics["counts"]["cache misses"],
+                               "revalidated": run_statistics["counts"]["cache revalidated"],
+                               "negative_hits": run_statistics["counts"]["negative cache hits"]}
 
     return (identifier_with_error_list,
             identifier_with_no_funder_list,
@@ -0,0 +1,127 @@
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from http_client import run_in_request_context
+from query_crossref import query_crossref, crossref_clean_input_list, crossref_normalize_doi
+from query_clinicaltrials import query_clinicaltrials, clinicaltrials_clean_input_list, clinicaltrials_normalize_nctid
+
+
+def combined_split_input_list(input_list: list):
+    """
+    Sorts a mixed list of identifiers into DOIs and NCTIDs in one pass, recognising each with its source's
+    normalizer, and cleans each with its source's cleaner.
+
+    :param input_list: list of DOIs and NCTIDs in any of the formats the Crossref and ClinicalTrials.gov pages accept
+    :return: cleaned list of DOIs, cleaned list of NCTIDs, and list of items that are neither
+    """
+    doi_list = []
+    nct_list = []
+    unrecognized_list = []
+    for item in input_list:
+        item = item.strip()
+        if item == '':
+            continue
+        elif clinicaltrials_normalize_nctid(item) is not None:
+            nct_list.append(item)
+        elif crossref_normalize_doi(item).startswith('10.'):
+            doi_list.append(item)
+        else:
+            unrecognized_list.append(item)
+    return (list(crossref_clean_input_list(doi_list)), list(clinicaltrials_clean_input_list(nct_list)),
+            unrecognized_list)
+
+
+def combined_merge_results(first_results: tuple, second_results: tuple):
+    """
+    Merges two result tuples of query_clinicaltrials (or of query_crossref).
+
+    :param first_results: tuple of lists and dictionaries returned by a query
+    :param second_results: tuple of the same shape
+    :return: tuple with the lists concatenated and the dictionaries merged
+    """
+    return tuple(first + second if isinstance(first, list) else {**first, **second}
+                 for first, second in zip(first_results, second_results))
+
+
+def query_combined(doi_list: list, nct_list: list, run_report: dict = None, hierarchy_source: str = "registry",
+                   use_public_data_index: bool = False, use_bulk_data_index: bool = False):
+    """
+    Queries Crossref for the DOIs and ClinicalTrials.gov for the NCTIDs at the same time. As soon as the Crossref
+    results are in, the trials the works list in their clinical-trial-number field are looked up too, while the
+    NCTIDs from the input may still be running, so the whole run takes about as long as the slower source.
+
+    :param doi_list: cleaned list of DOIs
+    :param nct_list: cleaned list of NCTIDs
+    :param run_report: optional dictionary that is filled with the run reports of the queries under "crossref",
+    "clinicaltrials" and "linked_clinicaltrials"
+    :param hierarchy_source: see query_crossref
+    :param use_public_data_index: see query_crossref
+    :param use_bulk_data_index: see query_clinicaltrials
+    :return: results of query_crossref, results of query_clinicaltrials for the input and linked NCTIDs together,
+    and dictionary of DOI to the NCTIDs it links to
+    """
+    crossref_report = {}
+    clinicaltrials_report = {}
+    linked_report = {}
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        crossref_future = executor.submit(run_in_request_context(query_crossref), doi_list,
+                                          run_report=crossref_report, hierarchy_source=hierarchy_source,
+                                          use_public_data_index=use_public_data_index)
+        clinicaltrials_future = executor.submit(run_in_request_context(query_clinicaltrials), nct_list,
+                                                run_report=clinicaltrials_report,
+                                                use_bulk_data_index=use_bulk_data_index)
+
+        crossref_results = crossref_future.result()
+        linked_trial_dictionary = crossref_report.get("clinical_trial_numbers", {})
+        queried_nct_set = {identifier.upper() for identifier in nct_list}
+        linked_nct_list = list(dict.fromkeys(trial_number for trial_list in linked_trial_dictionary.values()
+                                             for trial_number in trial_list if trial_number not in queried_nct_set))
+        linked_future = executor.submit(run_in_request_context(query_clinicaltrials), linked_nct_list,
+                                        run_report=linked_report, batch_lookup=True,
+                                        use_bulk_data_index=use_bulk_data_index) if linked_nct_list else None
+
+        clinicaltrials_results = clinicaltrials_future.result()
+        if linked_future is not None:
+            clinicaltrials_results = combined_merge_results(clinicaltrials_results, linked_future.result())
+
+    if run_report is not None:
+        run_report["crossref"] = crossref_report
+        run_report["clinicaltrials"] = clinicaltrials_report
+        run_report["linked_clinicaltrials"] = linked_report
+
+    return crossref_results, clinicaltrials_results, linked_trial_dictionary
+
+
+def combined_create_linked_table(nested_detailed_funder_dictionary: dict, lead_sponsor_dictionary: dict,
+                                 lead_sponsor_class_dictionary: dict, all_collaborators_dictionary: dict,
+                                 linked_trial_dictionary: dict):
+    """
+    Creates a table with one row per work and linked trial, showing the work's funders next to the trial's
+    sponsors.
+
+    :param nested_detailed_funder_dictionary: nested dictionaries containing detailed funder names, from
+    query_crossref
+    :param lead_sponsor_dictionary: lead sponsor per NCTID, from query_clinicaltrials
+    :param lead_sponsor_class_dictionary: lead sponsor class per NCTID, from query_clinicaltrials
+    :param all_collaborators_dictionary: collaborators per NCTID, from query_clinicaltrials
+    :param linked_trial_dictionary: dictionary of DOI to linked NCTIDs, from query_combined
+    :return: DataFrame of work DOI, funders, NCTID, lead sponsor, lead sponsor class and collaborators
+    """
+    # query_clinicaltrials keys its results by the NCTID as given, linked NCTIDs are upper case.
+    sponsor_lookup = {identifier.upper(): identifier for identifier in lead_sponsor_dictionary}
+    rows = []
+    for work, trial_list in linked_trial_dictionary.items():
+        funders = "; ".join(specific_name_list[-1]
+                            for funder_dictionary in nested_detailed_funder_dictionary.get(work, [])
+                            for specific_name_list in funder_dictionary.values() if specific_name_list)
+        for trial_number in trial_list:
+            identifier = sponsor_lookup.get(trial_number)
+            rows.append({"Work DOI": work,
+                         "Crossref funders": funders or "NA",
+                         "NCTID": trial_number,
+                         "Lead sponsor": lead_sponsor_dictionary.get(identifier, "NA"),
+                         "Lead sponsor class": lead_sponsor_class_dictionary.get(identifier, "NA"),
+                         "Collaborators": ", ".join(all_collaborators_dictionary.get(identifier, ["NA"]))})
+    return pd.DataFrame(rows, columns=["Work DOI", "Crossref funders", "NCTID", "Lead sponsor",
+                                       "Lead sponsor class", "Collaborators"])
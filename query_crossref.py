@@ -1,72 +1,159 @@
+import itertools
 import string
 import time
-import requests
 import re
+import urllib.parse
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
 import pycountry
 from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from htmltools import HTML
 
+from funder_registry_index import resolve_funder_from_index
+from input_reader import read_identifiers, extract_identifiers, iterate_chunks
+from crossref_public_data import crossref_public_data_lookup
+from query_clinicaltrials import clinicaltrials_normalize_nctid
+from http_client import (http_get, json_loads, run_in_request_context, record_run, latency_report, remember_good,
+                         classify_failure, record_failure, PERMANENT_FAILURE_CATEGORIES, RETRY_PASS_DELAY)
+from result_cache import (fetch_cached_json, cache_get_fresh_many, cache_get_failures_many, cache_put,
+                          cache_put_failure, cache_select_fresh, recall_cached_stale)
+
 
 def crossref_read_input_file(filename: str):
     """
-    Reads an input text file and returns it as a list.
+    Reads an input file (plain text, gzip or zip) line by line, see input_reader.read_identifiers.
 
     :param filename: path to the input file
-    :return: file contents as a list
+    :return: generator of lines
+    """
+    return read_identifiers(filename)
+
+
+def crossref_read_export_file(filename: str):
+    """
+    Reads the DOIs out of a bibliographic export (RIS, BibTeX, CSV, MEDLINE), see input_reader.extract_identifiers.
+
+    :param filename: path to the export file
+    :return: generator of DOIs
+    """
+    return extract_identifiers(filename, nctid=False)
+
+
+CROSSREF_DOI_PREFIX_PATTERN = re.compile(r'(?:https?://)?(?:dx\.)?(?:doi\.org/|doi:\s*)', re.IGNORECASE)
+
+
+def crossref_normalize_doi(item: str):
+    """
+    Removes whitespace and a "https://doi.org/", "doi:" or similar prefix from a DOI.
+
+    :param item: DOI in any of the formats crossref_clean_input_list accepts
+    :return: DOI in format "10.XXX/XXXX"; items that are not DOIs are returned without surrounding whitespace
     """
-    print(filename)
-    file = open(filename, "r")
-    input_data = file.read()
-    input_list = input_data.split("\n")
-    file.close()
-    return input_list
+    item = item.strip()
+    prefix_match = CROSSREF_DOI_PREFIX_PATTERN.match(item)
+    return item[prefix_match.end():].lstrip() if prefix_match else item
 
 
 def crossref_clean_input_list(input_list: list):
     """
-    Cleans common errors in input list to get DOIs in format "https://doi.org/10.XXX/XXX" or "doi:10.XXXX/XXX",
-    removing duplicates.
+    Cleans common errors in input list to get DOIs in format "10.XXX/XXX" from "https://doi.org/10.XXX/XXX",
+    "doi:10.XXXX/XXX" and similar, removing duplicates. DOIs are case-insensitive, so the first spelling of each
+    DOI is kept.
 
-    :param input_list: list of DOIs
-    :return: cleaned list of DOIs
+    :param input_list: list (or any iterable, e.g. crossref_read_input_file) of DOIs
+    :return: generator of cleaned DOIs, in input order
     """
-    cleaned_input_list = []
+    seen_item_set = set()
     for item in input_list:
-        if item == '':
+        search_item = crossref_normalize_doi(item)
+        if search_item and search_item.lower() not in seen_item_set:
+            seen_item_set.add(search_item.lower())
+            yield search_item
+
+
+REGISTRATION_AGENCY_URL = "https://doi.org/ra/"
+REGISTRATION_AGENCY_TTL = 30 * 24 * 3600.0  # Seconds the agency of a DOI prefix is remembered.
+REGISTRATION_AGENCY_MAX_URL_LENGTH = 2000
+
+
+def crossref_doi_prefix(identifier: str):
+    """
+    Returns the prefix of a DOI, which identifies the registrant and so its registration agency.
+
+    :param identifier: DOI in format "10.XXX/XXXX"
+    :return: lower-case prefix, e.g. "10.7554", or None if the identifier has no prefix
+    """
+    prefix, separator, _ = identifier.partition('/')
+    return prefix.lower() if separator and prefix.startswith('10.') else None
+
+
+def crossref_route_registration_agencies(cleaned_input_list: list):
+    """
+    Splits DOIs into those registered with Crossref and those registered with another agency (DataCite, mEDRA,
+    JaLC, ...), so that only Crossref DOIs are queried at Crossref. The agency is the same for all DOIs with a
+    prefix, so one DOI per unknown prefix is looked up at doi.org's "/ra/" endpoint, many per request, and the
+    answer is kept in the result cache. DOIs whose agency cannot be determined are sent to Crossref.
+
+    :param cleaned_input_list: input list of DOIs in format "10.XXX/XXXX"
+    :return: list of DOIs to query at Crossref (in input order) and dictionary of other DOIs to their agency
+    """
+    prefix_dictionary = {}
+    for identifier in cleaned_input_list:
+        prefix = crossref_doi_prefix(identifier)
+        if prefix is not None and ',' not in identifier:
+            prefix_dictionary.setdefault(prefix, identifier)
+    agency_dictionary = {prefix: agency["RA"]
+                         for prefix, agency in cache_select_fresh("doi-prefix-ra", list(prefix_dictionary)).items()}
+
+    sample_list = [identifier for prefix, identifier in prefix_dictionary.items() if prefix not in agency_dictionary]
+    batch_list = []
+    for identifier in sample_list:
+        quoted_identifier = urllib.parse.quote(identifier, safe='/:;()')
+        if batch_list and len(REGISTRATION_AGENCY_URL) + len(batch_list[-1]) + len(quoted_identifier) \
+                < REGISTRATION_AGENCY_MAX_URL_LENGTH:
+            batch_list[-1] += f",{quoted_identifier}"
+        else:
+            batch_list.append(quoted_identifier)
+    for batch in batch_list:
+        try:
+            response = http_get(REGISTRATION_AGENCY_URL + batch)
+            response.raise_for_status()
+            result_list = json_loads(response.content)
+        except Exception:
             continue
-        elif re.search(r'^10\.', item):
-            search_item = item
-        elif re.search(r'^DOI:', item):
-            new_item = re.sub(r'DOI:', '', item, 1)
-            search_item = new_item
-        elif re.search(r'^DOI: ', item):
-            new_item = re.sub(r'DOI: ', '', item, 1)
-            search_item = new_item
-        elif re.search(r'^doi:', item):
-            new_item = re.sub(r'doi:', '', item, 1)
-            search_item = new_item
-        elif re.search(r'^doi: ', item):
-            new_item = re.sub(r'doi: ', '', item, 1)
-            search_item = new_item
-        elif re.search(r'^doi.org/', item):
-            new_item = re.sub(r'doi.org/', '', item, 1)
-            search_item = new_item
-        elif re.search(r'^https://doi.org/', item):
-            new_item = re.sub(r'https://doi.org/', '', item, 1)
-            search_item = new_item
-        elif re.search(r'^http://doi.org/', item):
-            new_item = re.sub(r'http://doi.org/', '', item, 1)
-            search_item = new_item
+        for result in result_list:
+            # DOIs that do not exist or are invalid come back with a "status" instead of an "RA".
+            prefix = crossref_doi_prefix(result.get("DOI", ""))
+            if prefix is not None and result.get("RA"):
+                agency_dictionary[prefix] = result["RA"]
+                cache_put("doi-prefix-ra", prefix, {"RA": result["RA"]}, ttl=REGISTRATION_AGENCY_TTL)
+
+    crossref_identifier_list = []
+    not_crossref_dictionary = {}
+    for identifier in cleaned_input_list:
+        agency = agency_dictionary.get(crossref_doi_prefix(identifier), "Crossref")
+        if agency.lower() == "crossref":
+            crossref_identifier_list.append(identifier)
         else:
-            search_item = item
-        cleaned_input_list.append(search_item.strip())
-        cleaned_input_list = list(set(cleaned_input_list))
-    return cleaned_input_list
+            not_crossref_dictionary[identifier] = agency
+    return crossref_identifier_list, not_crossref_dictionary
+
+
+def crossref_fetch_funder_record(url: str):
+    """
+    Retrieves one funder record from the Crossref Funder Registry, from the result cache when it holds a fresh
+    copy. If the registry cannot be reached, the last known good record for the funder is returned instead and
+    reported as stale.
+
+    :param url: URL of the funder record, e.g. "https://data.crossref.org/fundingdata/funder/10.13039/100000002"
+    :return: funder record, or None if it could not be retrieved
+    """
+    funder_id = url.rstrip('/').rsplit('/', 1)[-1]
+    return fetch_cached_json("crossref-funder", funder_id, url, label=f"funder {funder_id}")
 
 
 def retrieve_broader_data(funder_identifier):
@@ -76,7 +163,7 @@ def retrieve_broader_data(funder_identifier):
     :return: list of funders (largest to smallest) under a given identifier
     """
     url = f"https://data.crossref.org/fundingdata/funder/{funder_identifier}"
-    response = requests.get(url)
+    result = crossref_fetch_funder_record(url)
 
     funders = []
     cycles = 0
@@ -84,9 +171,8 @@ def retrieve_broader_data(funder_identifier):
     funding_body_type_dictionary = {}
     country_dictionary = {}
 
-    while response.status_code == 200:
+    while result is not None:
         cycles += 1
-        result = response.json()
         funder_name = result["prefLabel"]["Label"]["literalForm"]["content"]
         funders.append(funder_name)
         while cycles == 1:
@@ -110,8 +196,7 @@ def retrieve_broader_data(funder_identifier):
         if broader_data:
             url = broader_data["resource"]
             # print("Broader Funding Data:", url)
-            time.sleep(0.02)
-            response = requests.get(url)
+            result = crossref_fetch_funder_record(url)
         else:
             # print("No further broader data found.")
             break
@@ -121,13 +206,504 @@ def retrieve_broader_data(funder_identifier):
     return funders_name_dictionary, funding_body_type_dictionary, country_dictionary
 
 
-def query_crossref(cleaned_input_list: list):
+def crossref_find_hierarchy_path(hierarchy: dict, funder_id: str):
+    """
+    Finds the chain of funder ids from the top of a REST "hierarchy" tree down to a given funder.
+
+    :param hierarchy: nested dictionary of funder id to children, as in the "/funders/{id}" response
+    :param funder_id: funder id to look for, e.g. "100000050"
+    :return: list of funder ids from the top-level funder to funder_id, or None if it is not in the tree
+    """
+    for node_id, children in hierarchy.items():
+        if node_id == funder_id:
+            return [node_id]
+        if isinstance(children, dict):
+            path = crossref_find_hierarchy_path(children, funder_id)
+            if path is not None:
+                return [node_id] + path
+    return None
+
+
+def crossref_country_code(location: str):
+    """
+    Converts a country name as given in the REST "location" field to the lower-case ISO 3166 alpha-3 code
+    used by the Funder Registry's addressCountry.
+
+    :param location: country name, e.g. "United States"
+    :return: country code, e.g. "usa", or the location itself if it is not a recognised country
+    """
+    try:
+        return pycountry.countries.lookup(location).alpha_3.lower()
+    except LookupError:
+        return location
+
+
+def retrieve_funder_ancestry(funder_identifier):
+    """
+    Retrieves the complete chain of broader funders for a funder from the Crossref REST "/funders/{id}" resource,
+    which lists all ancestors and their names in one response, instead of following "broader" links one level
+    at a time. The funding body type is only published in the Funder Registry record, so that record is fetched
+    for the funder itself (but not for its ancestors).
+
+    :param funder_identifier: Identifier of a given funder in Crossref, e.g. "10.13039/100000050"
+    :return: same as retrieve_broader_data: dictionaries of funder names (largest to smallest), funding body type
+    and country under the given identifier
+    """
+    funder_id = funder_identifier.rstrip('/').rsplit('/', 1)[-1]
+    message = fetch_cached_json("crossref-rest-funder", funder_id, f"https://api.crossref.org/funders/{funder_id}",
+                                extract=lambda result: result['message'], label=f"funder {funder_id}")
+    if message is None:
+        return retrieve_broader_data(funder_identifier)
+
+    hierarchy_names = message.get("hierarchy-names", {})
+    path = crossref_find_hierarchy_path(message.get("hierarchy", {}), funder_id) or [funder_id]
+    funders = []
+    for node_id in path:
+        if node_id == funder_id:
+            funders.append(message.get("name") or hierarchy_names.get(node_id))
+        else:
+            funders.append(hierarchy_names.get(node_id, node_id))
+
+    result = crossref_fetch_funder_record(f"https://data.crossref.org/fundingdata/funder/{funder_identifier}")
+    try:
+        funding_body = result["fundingBodySubType"]
+    except Exception:
+        funding_body = None
+    try:
+        funding_country = result["address"]["postalAddress"]["addressCountry"]
+    except Exception:
+        funding_country = crossref_country_code(message["location"]) if message.get("location") else None
+
+    return ({funder_identifier: funders},
+            {funder_identifier: [funding_body]},
+            {funder_identifier: [funding_country]})
+
+
+def crossref_resolve_registry_hierarchies(funder_identifier_list: list, max_workers: int = 8):
+    """
+    Resolves the Funder Registry hierarchy for many funders at once. Each funder record is fetched only once per
+    call, and all records of one level of the hierarchy (first the funders themselves, then their broader
+    parents, and so on) are fetched concurrently.
+
+    :param funder_identifier_list: list of unique funder identifiers, e.g. "10.13039/100000050"
+    :param max_workers: number of concurrent requests
+    :return: dictionary of funder identifier to the (names, funding body type, country) dictionaries that
+    retrieve_broader_data returns, and the number of funder records that were requested
+    """
+    funder_records = {}  # funder id -> registry record, or None if it could not be retrieved
+    level_urls = {funder_identifier.rstrip('/').rsplit('/', 1)[-1]:
+                  f"https://data.crossref.org/fundingdata/funder/{funder_identifier}"
+                  for funder_identifier in funder_identifier_list}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while level_urls:
+            level_records = executor.map(run_in_request_context(crossref_fetch_funder_record), level_urls.values())
+            funder_records.update(zip(level_urls.keys(), level_records))
+
+            next_level_urls = {}
+            for funder_id in level_urls:
+                broader_data = (funder_records[funder_id] or {}).get("broader", {})
+                if broader_data:
+                    broader_url = broader_data["resource"]
+                    broader_id = broader_url.rstrip('/').rsplit('/', 1)[-1]
+                    if broader_id not in funder_records:
+                        next_level_urls[broader_id] = broader_url
+            level_urls = next_level_urls
+
+    resolved_funder_dictionary = {}
+    for funder_identifier in funder_identifier_list:
+        funder_id = funder_identifier.rstrip('/').rsplit('/', 1)[-1]
+        result = funder_records.get(funder_id)
+        funders = []
+        funding_body_type_dictionary = {}
+        country_dictionary = {}
+        if result is not None:
+            funding_body_type_dictionary[funder_identifier] = [result.get("fundingBodySubType")]
+            try:
+                funding_country = result["address"]["postalAddress"]["addressCountry"]
+            except Exception:
+                funding_country = None
+            country_dictionary[funder_identifier] = [funding_country]
+
+        visited_ids = set()
+        while result is not None and funder_id not in visited_ids:
+            visited_ids.add(funder_id)
+            funders.append(result["prefLabel"]["Label"]["literalForm"]["content"])
+            broader_data = result.get("broader", {})
+            if not broader_data:
+                break
+            funder_id = broader_data["resource"].rstrip('/').rsplit('/', 1)[-1]
+            result = funder_records.get(funder_id)
+
+        resolved_funder_dictionary[funder_identifier] = ({funder_identifier: funders[::-1]},
+                                                         funding_body_type_dictionary,
+                                                         country_dictionary)
+    return resolved_funder_dictionary, len(funder_records)
+
+
+def crossref_resolve_funder_identifiers(funder_identifier_list: list, max_workers: int = 8,
+                                        hierarchy_source: str = "registry"):
+    """
+    Resolves the hierarchy of each funder in a list.
+
+    :param funder_identifier_list: list of distinct funder DOIs
+    :param max_workers: number of concurrent requests
+    :param hierarchy_source: "registry", "rest" or "index", see query_crossref
+    :return: dictionary of funder identifier to the (names, funding body type, country) dictionaries that
+    retrieve_broader_data returns, and the number of hierarchy requests made
+    """
+    if hierarchy_source == "index":
+        resolved_funder_dictionary = {}
+        for funder_identifier in funder_identifier_list:
+            resolved = resolve_funder_from_index(funder_identifier)
+            if resolved is not None:
+                resolved_funder_dictionary[funder_identifier] = resolved
+        # Funders newer than the index are resolved from the Funder Registry.
+        missing_identifier_list = [funder_identifier for funder_identifier in funder_identifier_list
+                                   if funder_identifier not in resolved_funder_dictionary]
+        missing_resolved_dictionary, request_count = crossref_resolve_registry_hierarchies(missing_identifier_list,
+                                                                                           max_workers)
+        resolved_funder_dictionary.update(missing_resolved_dictionary)
+    elif hierarchy_source == "rest":
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            resolved_list = executor.map(run_in_request_context(retrieve_funder_ancestry), funder_identifier_list)
+            resolved_funder_dictionary = dict(zip(funder_identifier_list, resolved_list))
+        # Two requests (REST resource and registry record) per funder.
+        request_count = 2 * len(funder_identifier_list)
+    else:
+        resolved_funder_dictionary, request_count = crossref_resolve_registry_hierarchies(funder_identifier_list,
+                                                                                          max_workers)
+    return resolved_funder_dictionary, request_count
+
+
+def crossref_hierarchy_requests_saved(resolved_funder_dictionary: dict, funder_occurrence_count: Counter,
+                                      request_count: int, hierarchy_source: str = "registry"):
+    """
+    Compares the hierarchy requests made with those resolving every funder of every work separately would cost.
+
+    :param resolved_funder_dictionary: dictionary of funder identifier to resolved hierarchy, from
+    crossref_resolve_funder_identifiers
+    :param funder_occurrence_count: Counter of funder identifier to the number of works listing it
+    :param request_count: number of hierarchy requests made
+    :param hierarchy_source: "registry", "rest" or "index", see query_crossref
+    :return: number of hierarchy requests saved
+    """
+    if hierarchy_source == "rest":
+        # Two requests per funder, no matter how high up its hierarchy goes.
+        separate_request_count = 2 * sum(funder_occurrence_count.values())
+    else:
+        # Walking each occurrence separately costs one request per level of its hierarchy.
+        separate_request_count = sum(max(1, len(resolved_funder_dictionary[funder_identifier][0][funder_identifier]))
+                                     * occurrence_count
+                                     for funder_identifier, occurrence_count in funder_occurrence_count.items())
+    return separate_request_count - request_count
+
+
+def crossref_resolve_funder_hierarchies(bottom_level_funder_dictionary: dict, max_workers: int = 8,
+                                        hierarchy_source: str = "registry"):
+    """
+    Resolves the hierarchy of every funder DOI listed on any work exactly once, so funders shared by many works
+    (e.g. NIH) are only looked up once per run.
+
+    :param bottom_level_funder_dictionary: dictionary of work DOI to list of funders from Crossref
+    :param max_workers: number of concurrent requests
+    :param hierarchy_source: "registry", "rest" or "index", see query_crossref
+    :return: dictionary of funder identifier to the (names, funding body type, country) dictionaries that
+    retrieve_broader_data returns, and the number of hierarchy requests saved compared to resolving every
+    funder of every work separately
+    """
+    funder_occurrence_count = Counter(funder.get("DOI")
+                                      for funders_list in bottom_level_funder_dictionary.values()
+                                      for funder in funders_list if funder.get("DOI"))
+    resolved_funder_dictionary, request_count = crossref_resolve_funder_identifiers(list(funder_occurrence_count),
+                                                                                    max_workers, hierarchy_source)
+    requests_saved = crossref_hierarchy_requests_saved(resolved_funder_dictionary, funder_occurrence_count,
+                                                       request_count, hierarchy_source)
+    return resolved_funder_dictionary, requests_saved
+
+
+def crossref_clinical_trial_numbers(metadata: dict):
+    """
+    Returns the ClinicalTrials.gov trials a work lists in its clinical-trial-number field. Registry strings such
+    as "NCT 01234567" or "NCTID: NCT01234567" are normalized like the ClinicalTrials.gov cleaner does.
+
+    :param metadata: Work metadata
+    :return: list of NCTIDs in format "NCT########", without duplicates
+    """
+    trial_list = []
+    for clinical_trial in metadata.get("clinical-trial-number", []):
+        trial_number = clinicaltrials_normalize_nctid(clinical_trial.get("clinical-trial-number", ""))
+        if trial_number is not None and trial_number not in trial_list:
+            trial_list.append(trial_number)
+    return trial_list
+
+
+def crossref_project_work(metadata: dict):
+    """
+    Keeps only the fields of a Work object that this app uses (see CROSSREF_PROJECTION_FIELDS).
+
+    :param metadata: Work metadata
+    :return: Work metadata restricted to the projection fields
+    """
+    return {field: metadata[field] for field in CROSSREF_PROJECTION_FIELDS.split(",") if field in metadata}
+
+
+def crossref_fetch_work(identifier: str, hedge: bool = False):
+    """
+    Retrieves the Work object for a single DOI from Crossref, from the result cache when it holds a fresh copy.
+    Only the fields in CROSSREF_PROJECTION_FIELDS are kept.
+
+    :param identifier: DOI in format "10.XXX/XXXX"
+    :param hedge: send a second request if the first is slower than recent Crossref requests
+    :return: metadata of the Work object (the last known good one if Crossref could not be reached),
+    or None if the query failed
+    """
+    return fetch_cached_json("crossref-work", identifier.lower(), f"https://api.crossref.org/works/{identifier}",
+                             extract=lambda result: crossref_project_work(result['message']), hedge=hedge,
+                             label=identifier)
+
+
+def crossref_fetch_works(cleaned_input_list: list, max_workers: int = 8, hedge: bool = False):
+    """
+    Retrieves Work objects for a list of DOIs, keeping up to max_workers requests in flight at once.
+    Requests still start at the Crossref rate enforced by http_client, the overlap only hides network latency.
+
+    :param cleaned_input_list: input list (or generator) of DOIs in format "10.XXX/XXXX". Each DOI is
+    submitted as soon as it is read, so a generator does not have to be exhausted before the first request.
+    :param max_workers: number of concurrent requests
+    :param hedge: send a second request for DOIs whose first request is slower than recent Crossref requests
+    :return: dictionary of DOI to Work metadata (None for DOIs that could not be queried), in input order
+    """
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        future_dictionary = {identifier: executor.submit(run_in_request_context(crossref_fetch_work), identifier,
+                                                         hedge)
+                             for identifier in cleaned_input_list}
+        return {identifier: future.result() for identifier, future in future_dictionary.items()}
+
+
+CROSSREF_BATCH_MAX_URL_LENGTH = 4000  # Stay well below common proxy/server URL length limits.
+CROSSREF_BATCH_MAX_ROWS = 100
+CROSSREF_PROJECTION_FIELDS = "DOI,funder,clinical-trial-number"
+CROSSREF_STREAM_CHUNK_SIZE = 1000  # DOIs looked up in the cache and indexes at a time while the input is read.
+
+
+def crossref_create_batches(cleaned_input_list: list, batch_size: int = CROSSREF_BATCH_MAX_ROWS):
+    """
+    Groups DOIs into chunks whose "filter=doi:...,doi:..." query string stays under the URL length limit.
+    DOIs containing a comma cannot be expressed in a filter and are put in a chunk of their own.
+
+    :param cleaned_input_list: input list (or generator) of DOIs in format "10.XXX/XXXX"
+    :param batch_size: maximum number of DOIs per chunk
+    :return: generator of DOI lists
+    """
+    current_batch = []
+    current_length = 0
+    for identifier in cleaned_input_list:
+        if ',' in identifier:
+            yield [identifier]
+            continue
+        filter_length = len(urllib.parse.quote(f"doi:{identifier},", safe=''))
+        if current_batch and (current_length + filter_length > CROSSREF_BATCH_MAX_URL_LENGTH
+                              or len(current_batch) >= batch_size):
+            yield current_batch
+            current_batch = []
+            current_length = 0
+        current_batch.append(identifier)
+        current_length += filter_length
+    if current_batch:
+        yield current_batch
+
+
+def crossref_fetch_work_batch(identifier_batch: list, projection: bool = False, hedge: bool = False):
+    """
+    Retrieves the Work objects for several DOIs with a single "/works?filter=doi:..." request.
+
+    :param identifier_batch: list of DOIs in format "10.XXX/XXXX"
+    :param projection: only request the DOI and funder fields of each Work object
+    :param hedge: send a second request if the first is slower than recent Crossref requests
+    :return: dictionary of DOI to Work metadata, with None for DOIs Crossref did not return. If the request
+    failed, the last known good metadata is used for DOIs that have it. DOIs left without metadata are
+    recorded as failures; DOIs missing from a successful answer are remembered as not found.
+    """
+    if len(identifier_batch) == 1 and ',' in identifier_batch[0]:
+        return {identifier_batch[0]: crossref_fetch_work(identifier_batch[0], hedge)}
+
+    params = {"filter": ",".join(f"doi:{identifier}" for identifier in identifier_batch),
+              "rows": len(identifier_batch)}
+    if projection:
+        params["select"] = CROSSREF_PROJECTION_FIELDS
+
+    work_metadata_dictionary = dict.fromkeys(identifier_batch)
+    try:
+        response = http_get("https://api.crossref.org/works", params=params, hedge=hedge)
+        response.raise_for_status()
+        result = json_loads(response.content)
+        items = result['message']['items']
+    except Exception as error:
+        category = classify_failure(error)
+        if category in PERMANENT_FAILURE_CATEGORIES and len(identifier_batch) > 1:
+            # One bad DOI can get the whole filter rejected, the retry pass looks each DOI up on its own.
+            category = "batch rejected"
+        for identifier in identifier_batch:
+            work_metadata_dictionary[identifier] = recall_cached_stale("crossref-work", identifier.lower(),
+                                                                       identifier)
+            if work_metadata_dictionary[identifier] is None:
+                record_failure(identifier, category)
+        return work_metadata_dictionary
+
+    # Crossref returns DOIs in lower case, DOIs themselves are case-insensitive.
+    identifier_lookup = {identifier.lower(): identifier for identifier in identifier_batch}
+    for item in items:
+        identifier = identifier_lookup.get(item.get('DOI', '').lower())
+        if identifier is not None:
+            work_metadata_dictionary[identifier] = item
+            remember_good("crossref-work", identifier.lower(), crossref_project_work(item))
+            cache_put("crossref-work", identifier.lower(), crossref_project_work(item))
+    for identifier, metadata in work_metadata_dictionary.items():
+        if metadata is None:
+            record_failure(identifier, "not found")
+            cache_put_failure("crossref-work", identifier.lower(), "not found")
+    return work_metadata_dictionary
+
+
+def crossref_fetch_works_batched(cleaned_input_list: list, max_workers: int = 8,
+                                 batch_size: int = CROSSREF_BATCH_MAX_ROWS, projection: bool = False,
+                                 hedge: bool = False):
+    """
+    Retrieves Work objects for a list of DOIs using batched filter queries, sending up to max_workers
+    batches at once. DOIs with a fresh entry in the result cache, or remembered as not found, are not requested.
+    The input is read CROSSREF_STREAM_CHUNK_SIZE DOIs at a time and each chunk's batches are sent before the
+    next chunk is read.
+
+    :param cleaned_input_list: input list (or generator) of DOIs in format "10.XXX/XXXX"
+    :param max_workers: number of concurrent requests
+    :param batch_size: maximum number of DOIs per request
+    :param projection: only request the DOI and funder fields of each Work object
+    :param hedge: send a second request for batches whose first request is slower than recent Crossref requests
+    :return: dictionary of DOI to Work metadata (None for DOIs that were not found), in input order
+    """
+    work_metadata_dictionary = {}
+    future_list = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for identifier_chunk in iterate_chunks(cleaned_input_list, CROSSREF_STREAM_CHUNK_SIZE):
+            cached_dictionary = cache_get_fresh_many("crossref-work",
+                                                     [identifier.lower() for identifier in identifier_chunk])
+            for identifier in identifier_chunk:
+                work_metadata_dictionary[identifier] = cached_dictionary.get(identifier.lower())
+            missing_identifier_list = [identifier for identifier in identifier_chunk
+                                       if work_metadata_dictionary[identifier] is None]
+            failure_dictionary = cache_get_failures_many("crossref-work",
+                                                         [identifier.lower() for identifier in missing_identifier_list],
+                                                         missing_identifier_list)
+            missing_identifier_list = [identifier for identifier in missing_identifier_list
+                                       if identifier.lower() not in failure_dictionary]
+            future_list.extend(executor.submit(run_in_request_context(crossref_fetch_work_batch), identifier_batch,
+                                               projection, hedge)
+                               for identifier_batch in crossref_create_batches(missing_identifier_list, batch_size))
+        for future in future_list:
+            work_metadata_dictionary.update(future.result())
+    return work_metadata_dictionary
+
+
+def crossref_prepare_identifiers(cleaned_input_list, indexed_dictionary: dict, not_crossref_dictionary: dict,
+                                 use_public_data_index: bool = False, route_registration_agency: bool = True):
+    """
+    Reads DOIs CROSSREF_STREAM_CHUNK_SIZE at a time and yields those that have to be queried at Crossref, so the
+    fetchers can start on the first chunk while the rest of the input is still being read.
+
+    :param cleaned_input_list: input list (or generator) of DOIs in format "10.XXX/XXXX"
+    :param indexed_dictionary: dictionary that is filled with the DOIs answered from the public data file index
+    :param not_crossref_dictionary: dictionary that is filled with the DOIs of other registration agencies
+    :param use_public_data_index: see query_crossref
+    :param route_registration_agency: see query_crossref
+    :return: generator of DOIs
+    """
+    for identifier_chunk in iterate_chunks(cleaned_input_list, CROSSREF_STREAM_CHUNK_SIZE):
+        if use_public_data_index:
+            chunk_indexed_dictionary = crossref_public_data_lookup(identifier_chunk)
+            indexed_dictionary.update(chunk_indexed_dictionary)
+            identifier_chunk = [identifier for identifier in identifier_chunk
+                                if identifier not in chunk_indexed_dictionary]
+        if route_registration_agency:
+            identifier_chunk, chunk_not_crossref_dictionary = crossref_route_registration_agencies(identifier_chunk)
+            not_crossref_dictionary.update(chunk_not_crossref_dictionary)
+        yield from identifier_chunk
+
+
+def crossref_normalize_funders(funders_list: list, resolved_funder_dictionary: dict, no_funder_doi_counter):
+    """
+    Builds the nested funder structures of one work from its list of funders and the resolved hierarchies.
+
+    :param funders_list: "funder" field of a Crossref Work object
+    :param resolved_funder_dictionary: dictionary of funder identifier to resolved hierarchy, from
+    crossref_resolve_funder_hierarchies
+    :param no_funder_doi_counter: itertools.count shared by all works of a run, numbering funders without a DOI
+    :return: lists of funder name, funding body type, country and grant dictionaries, one per funder
+    """
+    nested_list_of_funders = []
+    nested_list_of_grants = []
+    nested_list_of_funding_body_type = []
+    nested_list_of_countries = []
+
+    for funder in funders_list:
+        funder_doi = funder.get("DOI")
+        if funder_doi:
+            detailed_funder_dictionary, funding_body_type_dictionary, country_dictionary \
+                = [{key: list(value) for key, value in resolved_dictionary.items()}
+                   for resolved_dictionary in resolved_funder_dictionary[funder_doi]]
+        else:
+            no_funder_doi_count = next(no_funder_doi_counter)
+            detailed_funder_dictionary, funding_body_type_dictionary, country_dictionary \
+                = ({f'No funder DOI {no_funder_doi_count}': [funder["name"]]},
+                   {f'No funder DOI {no_funder_doi_count}': ['NA']},
+                   {f'No funder DOI {no_funder_doi_count}': ['NA']})
+
+        nested_list_of_funders.append(detailed_funder_dictionary)
+        nested_list_of_funding_body_type.append(funding_body_type_dictionary)
+        nested_list_of_countries.append(country_dictionary)
+
+        grant_dictionary = {}
+        grant = funder.get("award")
+        if funder_doi and grant:
+            grant_dictionary[funder_doi] = [grant]
+        elif funder_doi and not grant:
+            grant_dictionary[funder_doi] = ['NA']
+        elif not funder_doi and grant:
+            grant_dictionary[f'No funder DOI {no_funder_doi_count}'] = [grant]
+        else:
+            grant_dictionary[f'No funder DOI {no_funder_doi_count}'] = ['NA']
+        nested_list_of_grants.append(grant_dictionary)
+
+    return nested_list_of_funders, nested_list_of_funding_body_type, nested_list_of_countries, nested_list_of_grants
+
+
+def query_crossref(cleaned_input_list: list, max_workers: int = 8, batch_lookup: bool = False,
+                   projection: bool = False, hedge: bool = False, run_report: dict = None,
+                   hierarchy_source: str = "registry", route_registration_agency: bool = True,
+                   use_public_data_index: bool = False):
     """
     Queries Crossref for funders of items with specific DOIs. See Crossref documentation for more
     details: https://www.crossref.org/documentation/retrieve-metadata/rest-api/ and
     https://api.crossref.org/swagger-ui/index.html#/.
 
-    :param cleaned_input_list: input list of DOIs in format "10.XXX/XXXX"
+    :param cleaned_input_list: input list of DOIs in format "10.XXX/XXXX", or a generator such as
+    crossref_clean_input_list(crossref_read_input_file(...)), which is read while the first DOIs are fetched
+    :param max_workers: number of concurrent requests to Crossref
+    :param batch_lookup: resolve many DOIs per request with the "/works?filter=doi:..." endpoint
+    :param projection: only download the DOI and funder fields of each Work object. Crossref only supports
+    this on list queries, so each DOI is sent as a one-item filter query unless batch_lookup is also set.
+    :param hedge: send a second request for DOIs whose first request is slower than the recent p95
+    :param run_report: optional dictionary that is filled with statistics about the run: latency per host,
+    the works and funders that were served from last known good data because their upstream failed, and the
+    failure category of each DOI with an error. DOIs that failed transiently are retried once at the end.
+    :param hierarchy_source: "registry" follows the Funder Registry's broader links one request per level,
+    "rest" resolves each funder's full ancestry from the REST "/funders/{id}" resource, and "index" looks funders
+    up in the local index built by funder_registry_index.py, falling back to the registry for funders missing
+    from it. Either way each distinct funder is resolved once per run and shared by all works that list it.
+    :param route_registration_agency: look up the registration agency of each DOI prefix first and only query
+    Crossref DOIs; the others are listed in run_report["not_crossref"] with their agency instead of as errors
+    :param use_public_data_index: answer from the index built by crossref_public_data.py first and only query
+    the API for DOIs that are not in it (e.g. registered after the snapshot)
+    The ClinicalTrials.gov trials each work lists are put in run_report["clinical_trial_numbers"].
     :return: list of dictionaries with attributes for Work objects from returned queries in Crossref.
     """
     identifier_with_error_list = []
@@ -139,70 +715,87 @@ def query_crossref(cleaned_input_list: list):
     nested_countries_dictionary = {}
     nested_grant_dictionary = {}
 
-    for identifier in cleaned_input_list:
-        try:
-            work_url = f"https://api.crossref.org/works/{identifier}"
-            response = requests.get(work_url)
-            result = response.json()
-            metadata = result['message']
-
+    with record_run() as run_statistics:
+        indexed_dictionary = {}
+        not_crossref_dictionary = {}
+        cleaned_input_list = crossref_prepare_identifiers(cleaned_input_list, indexed_dictionary,
+                                                          not_crossref_dictionary, use_public_data_index,
+                                                          route_registration_agency)
+
+        if batch_lookup:
+            work_metadata_dictionary = crossref_fetch_works_batched(cleaned_input_list, max_workers,
+                                                                    projection=projection, hedge=hedge)
+        elif projection:
+            work_metadata_dictionary = crossref_fetch_works_batched(cleaned_input_list, max_workers,
+                                                                    batch_size=1, projection=True, hedge=hedge)
+        else:
+            work_metadata_dictionary = crossref_fetch_works(cleaned_input_list, max_workers, hedge)
+
+        retry_identifier_list = [identifier for identifier, metadata in work_metadata_dictionary.items()
+                                 if metadata is None
+                                 and run_statistics["failures"].get(identifier) not in PERMANENT_FAILURE_CATEGORIES]
+        if retry_identifier_list:
+            time.sleep(RETRY_PASS_DELAY)
+            work_metadata_dictionary.update(crossref_fetch_works(retry_identifier_list, max_workers, hedge))
+
+        work_metadata_dictionary = {**indexed_dictionary, **work_metadata_dictionary}
+        clinical_trial_dictionary = {}
+        for identifier, metadata in work_metadata_dictionary.items():
+            if metadata is None:
+                identifier_with_error_list.append(identifier)
+                continue
+            trial_list = crossref_clinical_trial_numbers(metadata)
+            if trial_list:
+                clinical_trial_dictionary[identifier] = trial_list
             if "funder" in metadata:
                 bottom_level_funder_dictionary[identifier] = metadata['funder']
             else:
                 identifier_with_no_funder_list.append(identifier)
-            time.sleep(0.02)  # Crossref has a limit of max 50 requests per second.
 
-        except Exception:
-            identifier_with_error_list.append(identifier)
-            continue
+        resolved_funder_dictionary, hierarchy_requests_saved \
+            = crossref_resolve_funder_hierarchies(bottom_level_funder_dictionary, max_workers, hierarchy_source)
 
-    no_funder_doi_count = 0
-    for original_work, funders_list in bottom_level_funder_dictionary.items():
-        nested_list_of_funders = []
-        nested_list_of_grants = []
-        nested_list_of_funding_body_type = []
-        nested_list_of_countries = []
-
-        for funder in funders_list:
-            funder_doi = funder.get("DOI")
-            if funder_doi:
-                detailed_funder_dictionary, funding_body_type_dictionary, country_dictionary \
-                    = retrieve_broader_data(funder_doi)
-            else:
-                no_funder_doi_count += 1
-                detailed_funder_dictionary, funding_body_type_dictionary, country_dictionary \
-                    = ({f'No funder DOI {no_funder_doi_count}': [funder["name"]]},
-                       {f'No funder DOI {no_funder_doi_count}': ['NA']},
-                       {f'No funder DOI {no_funder_doi_count}': ['NA']})
-
-            nested_list_of_funders.append(detailed_funder_dictionary)
-            nested_list_of_funding_body_type.append(funding_body_type_dictionary)
-            nested_list_of_countries.append(country_dictionary)
-
-            grant_dictionary = {}
-            grant = funder.get("award")
-            if funder_doi and grant:
-                grant_dictionary[funder_doi] = [grant]
-            elif funder_doi and not grant:
-                grant_dictionary[funder_doi] = ['NA']
-            elif not funder_doi and grant:
-                grant_dictionary[f'No funder DOI {no_funder_doi_count}'] = [grant]
-            else:
-                grant_dictionary[f'No funder DOI {no_funder_doi_count}'] = ['NA']
-            nested_list_of_grants.append(grant_dictionary)
+        no_funder_doi_counter = itertools.count(1)
+        for original_work, funders_list in bottom_level_funder_dictionary.items():
+            (nested_detailed_funder_dictionary[original_work],
+             nested_funding_body_type_dictionary[original_work],
+             nested_countries_dictionary[original_work],
+             nested_grant_dictionary[original_work]) \
+                = crossref_normalize_funders(funders_list, resolved_funder_dictionary, no_funder_doi_counter)
 
-        nested_detailed_funder_dictionary[original_work] = nested_list_of_funders
-        nested_funding_body_type_dictionary[original_work] = nested_list_of_funding_body_type
-        nested_countries_dictionary[original_work] = nested_list_of_countries
-        nested_grant_dictionary[original_work] = nested_list_of_grants
+    identifier_failure_dictionary = {identifier: run_statistics["failures"].get(identifier, "unexpected response")
+                                     for identifier in identifier_with_error_list}
 
     print(f"error: {identifier_with_error_list}")
+    print(f"failure categories: {identifier_failure_dictionary}")
+    print(f"retried: {retry_identifier_list}")
+    print(f"not crossref: {not_crossref_dictionary}")
+    print(f"answered from public data index: {len(indexed_dictionary)}")
+    print(f"clinical trials: {clinical_trial_dictionary}")
     print(f"no funder: {identifier_with_no_funder_list}")
     print(f"bottom level funder: {bottom_level_funder_dictionary}")
     print(f"detailed name: {nested_detailed_funder_dictionary}")
     print(f"body type: {nested_funding_body_type_dictionary}")
     print(f"country: {nested_countries_dictionary}")
     print(f"grant: {nested_grant_dictionary}")
+    print(f"latency: {latency_report(run_statistics['latency'])}")
+    print(f"stale: {run_statistics['stale']}")
+    print(f"hierarchy requests saved: {hierarchy_requests_saved}")
+    print(f"cache: {dict(run_statistics['counts'])}")
+
+    if run_report is not None:
+        run_report["latency"] = latency_report(run_statistics["latency"])
+        run_report["stale"] = run_statistics["stale"]
+        run_report["hierarchy_requests_saved"] = hierarchy_requests_saved
+        run_report["failures"] = identifier_failure_dictionary
+        run_report["retried"] = len(retry_identifier_list)
+        run_report["not_crossref"] = not_crossref_dictionary
+        run_report["index_hits"] = len(indexed_dictionary)
+        run_report["clinical_trial_numbers"] = clinical_trial_dictionary
+        run_report["cache"] = {"hits": run_statistics["counts"]["cache hits"],
+                               "misses": run_statistics["counts"]["cache misses"],
+                               "revalidated": run_statistics["counts"]["cache revalidated"],
+                               "negative_hits": run_statistics["counts"]["negative cache hits"]}
 
     return (identifier_with_error_list,
             identifier_with_no_funder_list,
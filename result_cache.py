@@ -0,0 +1,352 @@
+import contextlib
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from http_client import (http_get, json_loads, remember_good, recall_stale, record_stale, count_in_run,
+                         classify_failure, record_failure, record_demand, on_run_exit, PERMANENT_FAILURE_CATEGORIES)
+
+CACHE_PATH = os.environ.get("WHOFUNDEDIT_CACHE", "data/result_cache.sqlite3")  # Empty string disables the cache.
+# Seconds an entry is served without asking the upstream again.
+CACHE_TTL = float(os.environ.get("WHOFUNDEDIT_CACHE_TTL", 7 * 24 * 3600))
+# Seconds a permanent failure (not found, invalid identifier) is remembered before it is looked up again.
+NEGATIVE_CACHE_TTL = float(os.environ.get("WHOFUNDEDIT_NEGATIVE_CACHE_TTL", 24 * 3600))
+
+_connections = threading.local()
+_track_demand = contextvars.ContextVar("track_demand", default=True)
+_force_revalidation = contextvars.ContextVar("force_revalidation", default=False)
+
+
+def get_cache_connection():
+    """
+    Returns this thread's connection to the cache database, creating the database on first use.
+
+    :return: sqlite3.Connection, or None if the cache is disabled
+    """
+    if not CACHE_PATH:
+        return None
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(CACHE_PATH, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                  kind TEXT NOT NULL,
+                                  key TEXT NOT NULL,
+                                  data BLOB,
+                                  etag TEXT,
+                                  last_modified TEXT,
+                                  fetched_at REAL NOT NULL,
+                                  expires_at REAL NOT NULL,
+                                  PRIMARY KEY (kind, key))""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS demand (
+                                  kind TEXT NOT NULL,
+                                  key TEXT NOT NULL,
+                                  requests INTEGER NOT NULL,
+                                  last_requested_at REAL NOT NULL,
+                                  PRIMARY KEY (kind, key))""")
+        connection.commit()
+        _connections.connection = connection
+    return connection
+
+
+@contextlib.contextmanager
+def untracked_demand():
+    """
+    Lookups made inside the block are not counted as demand, e.g. those of the background refresher.
+    """
+    token = _track_demand.set(False)
+    try:
+        yield
+    finally:
+        _track_demand.reset(token)
+
+
+@contextlib.contextmanager
+def forced_revalidation():
+    """
+    Lookups made inside the block ask the upstream even when their cache entry is still fresh, e.g. those of the
+    background refresher. The entry is only renewed or replaced when the upstream answers, so a failed lookup
+    leaves it as fresh as it was.
+    """
+    token = _force_revalidation.set(True)
+    try:
+        yield
+    finally:
+        _force_revalidation.reset(token)
+
+
+def cache_track_demand(kind: str, key_list: list):
+    """
+    Counts a lookup of each item, so the background refresher knows which entries users ask for most. Inside
+    a recorded run the counts are kept in memory and written in one transaction when the run ends.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key_list: normalized identifiers
+    """
+    if not CACHE_PATH or not _track_demand.get() or record_demand(kind, key_list):
+        return
+    cache_write_demand({(kind, key): 1 for key in key_list})
+
+
+def cache_write_demand(demand_dictionary: dict):
+    """
+    Adds lookup counts to the demand table.
+
+    :param demand_dictionary: dictionary of (kind, key) to number of lookups
+    """
+    connection = get_cache_connection()
+    if connection is None or not demand_dictionary:
+        return
+    now = time.time()
+    with connection:
+        connection.executemany("INSERT INTO demand VALUES (?, ?, ?, ?) ON CONFLICT (kind, key) DO UPDATE "
+                               "SET requests = requests + excluded.requests, "
+                               "last_requested_at = excluded.last_requested_at",
+                               ((kind, key, requests, now) for (kind, key), requests in demand_dictionary.items()))
+
+
+on_run_exit(lambda run_statistics: cache_write_demand(run_statistics["demand"]))
+
+
+def cache_refresh_candidates(kinds: list, expiring_before: float, requested_since: float, limit: int):
+    """
+    Lists the most requested cache entries that expire soon (or already have), most requested first.
+
+    :param kinds: kinds of item to consider
+    :param expiring_before: only entries that expire before this time
+    :param requested_since: only items looked up at or after this time
+    :param limit: maximum number of entries
+    :return: list of (kind, key) pairs
+    """
+    connection = get_cache_connection()
+    if connection is None:
+        return []
+    return connection.execute(f"SELECT demand.kind, demand.key FROM demand JOIN entries "
+                              f"ON entries.kind = demand.kind AND entries.key = demand.key "
+                              f"WHERE demand.kind IN ({','.join('?' * len(kinds))}) "
+                              f"AND entries.expires_at < ? AND demand.last_requested_at >= ? "
+                              f"ORDER BY demand.requests DESC LIMIT ?",
+                              (*kinds, expiring_before, requested_since, limit)).fetchall()
+
+
+def cache_forget_demand(requested_before: float):
+    """
+    Drops the demand counts of items that have not been looked up since a given time.
+
+    :param requested_before: time before which demand is forgotten
+    """
+    connection = get_cache_connection()
+    if connection is None:
+        return
+    with connection:
+        connection.execute("DELETE FROM demand WHERE last_requested_at < ?", (requested_before,))
+
+
+def cache_get(kind: str, key: str):
+    """
+    Looks up a cache entry, fresh or expired.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key: normalized identifier of the item, e.g. a lower-case DOI
+    :return: dictionary with data, etag, last_modified, fetched_at and fresh, or None if there is no entry
+    """
+    connection = get_cache_connection()
+    if connection is None:
+        return None
+    row = connection.execute("SELECT data, etag, last_modified, fetched_at, expires_at FROM entries "
+                             "WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+    if row is None:
+        return None
+    data, etag, last_modified, fetched_at, expires_at = row
+    return {"data": json_loads(data),
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": fetched_at,
+            "fresh": expires_at > time.time()}
+
+
+def cache_select_fresh(kind: str, key_list: list):
+    """
+    Looks up many cache entries at once and returns the ones that are still fresh.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key_list: normalized identifiers
+    :return: dictionary of key to cached data for fresh entries
+    """
+    fresh_dictionary = {}
+    connection = get_cache_connection()
+    if connection is not None:
+        now = time.time()
+        for start in range(0, len(key_list), 500):
+            key_batch = key_list[start:start + 500]
+            rows = connection.execute(f"SELECT key, data FROM entries WHERE kind = ? AND expires_at > ? "
+                                      f"AND key IN ({','.join('?' * len(key_batch))})",
+                                      (kind, now, *key_batch))
+            fresh_dictionary.update((key, json_loads(data)) for key, data in rows)
+    return fresh_dictionary
+
+
+def cache_get_fresh_many(kind: str, key_list: list):
+    """
+    Looks up many cache entries at once and returns the ones that are still fresh, counting hits and misses.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key_list: normalized identifiers
+    :return: dictionary of key to cached data for fresh entries
+    """
+    cache_track_demand(kind, key_list)
+    fresh_dictionary = cache_select_fresh(kind, key_list)
+    count_in_run("cache hits", len(fresh_dictionary))
+    count_in_run("cache misses", len(set(key_list)) - len(fresh_dictionary))
+    return fresh_dictionary
+
+
+def cache_put(kind: str, key: str, data, etag: str = None, last_modified: str = None, ttl: float = None):
+    """
+    Stores or replaces a cache entry.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key: normalized identifier of the item
+    :param data: JSON-serialisable data
+    :param etag: ETag response header, for conditional revalidation
+    :param last_modified: Last-Modified response header, for conditional revalidation
+    :param ttl: seconds until the entry expires, defaults to CACHE_TTL
+    """
+    connection = get_cache_connection()
+    if connection is None:
+        return
+    now = time.time()
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (kind, key, json.dumps(data, separators=(",", ":")), etag, last_modified,
+                            now, now + (CACHE_TTL if ttl is None else ttl)))
+
+
+def cache_put_failure(kind: str, key: str, category: str):
+    """
+    Remembers a permanent failure for NEGATIVE_CACHE_TTL, so repeated uploads skip the item without a request.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key: normalized identifier of the item
+    :param category: failure category from classify_failure
+    """
+    cache_put(f"{kind}-failure", key, {"category": category}, ttl=NEGATIVE_CACHE_TTL)
+
+
+def cache_get_failures_many(kind: str, key_list: list, label_list: list = None):
+    """
+    Looks up remembered permanent failures for the items cache_get_fresh_many missed, and records them in the
+    current run. They are moved from the cache misses to the negative cache hits count.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key_list: normalized identifiers
+    :param label_list: how the items are listed in the run report, defaults to key_list
+    :return: dictionary of key to failure category for items with a remembered failure
+    """
+    failure_dictionary = {key: failure["category"]
+                          for key, failure in cache_select_fresh(f"{kind}-failure", key_list).items()}
+    for key, label in zip(key_list, label_list or key_list):
+        if key in failure_dictionary:
+            record_failure(label, failure_dictionary[key])
+    count_in_run("cache misses", -len(failure_dictionary))
+    count_in_run("negative cache hits", len(failure_dictionary))
+    return failure_dictionary
+
+
+def cache_renew(kind: str, key: str, ttl: float = None):
+    """
+    Extends the lifetime of an entry after the upstream confirmed (304 Not Modified) that it is unchanged.
+
+    :param kind: kind of item
+    :param key: normalized identifier of the item
+    :param ttl: seconds until the entry expires, defaults to CACHE_TTL
+    """
+    connection = get_cache_connection()
+    if connection is None:
+        return
+    now = time.time()
+    with connection:
+        connection.execute("UPDATE entries SET fetched_at = ?, expires_at = ? WHERE kind = ? AND key = ?",
+                           (now, now + (CACHE_TTL if ttl is None else ttl), kind, key))
+
+
+def recall_cached_stale(kind: str, key: str, label: str = None):
+    """
+    Returns the expired cache entry or, failing that, the in-memory last known good data for an item whose
+    upstream request failed, and records in the current run that it was served stale.
+
+    :param kind: kind of item
+    :param key: normalized identifier of the item
+    :param label: how the item is listed in the run report, defaults to key
+    :return: stale data, or None if there is none
+    """
+    cached = cache_get(kind, key)
+    if cached is not None:
+        record_stale(label or key)
+        return cached["data"]
+    return recall_stale(kind, key, label)
+
+
+def fetch_cached_json(kind: str, key: str, url: str, extract=None, params: dict = None, hedge: bool = False,
+                      label: str = None):
+    """
+    Returns the data for one item from the cache, and only goes to the network when there is no fresh entry
+    and no remembered permanent failure. Expired entries are revalidated with If-None-Match/If-Modified-Since
+    where the upstream sent validators. Permanent failures are remembered in the negative cache. If the
+    upstream fails transiently, the expired entry (or the in-memory last known good data) is served and
+    reported as stale. Failures are recorded in the current run with their category.
+
+    :param kind: kind of item, e.g. "crossref-work"
+    :param key: normalized identifier of the item
+    :param url: URL to request on a miss
+    :param extract: function turning the decoded response into the data to keep, defaults to keeping all of it
+    :param params: query string parameters
+    :param hedge: send a second request if the first is slower than recent requests to the host
+    :param label: how the item is listed in the run report, defaults to key
+    :return: data, or None if the item could not be retrieved
+    """
+    cache_track_demand(kind, [key])
+    cached = cache_get(kind, key)
+    if cached is not None and cached["fresh"] and not _force_revalidation.get():
+        count_in_run("cache hits")
+        return cached["data"]
+    failure = cache_get(f"{kind}-failure", key)
+    if failure is not None and failure["fresh"]:
+        count_in_run("negative cache hits")
+        record_failure(label or key, failure["data"]["category"])
+        return None
+    count_in_run("cache misses")
+
+    headers = {}
+    if cached is not None and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached is not None and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        response = http_get(url, params=params, headers=headers or None, hedge=hedge)
+        if response.status_code == 304 and cached is not None:
+            count_in_run("cache revalidated")
+            cache_renew(kind, key)
+            return cached["data"]
+        category = classify_failure(status_code=response.status_code) if response.status_code >= 400 else None
+        if category in PERMANENT_FAILURE_CATEGORIES:
+            cache_put_failure(kind, key, category)
+            record_failure(label or key, category)
+            return None
+        response.raise_for_status()
+        data = json_loads(response.content)
+        if extract is not None:
+            data = extract(data)
+    except Exception as error:
+        data = recall_cached_stale(kind, key, label)
+        if data is None:
+            record_failure(label or key, classify_failure(error))
+        return data
+
+    cache_put(kind, key, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    remember_good(kind, key, data)
+    return data
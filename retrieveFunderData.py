@@ -1,9 +1,9 @@
-import requests
+from http_client import http_get
 import datetime
 
 def retrieve_funder_info(doi):
     url = f"https://api.crossref.org/works/{doi}"
-    response = requests.get(url)
+    response = http_get(url)
     
     if response.status_code == 200:
         data = response.json()
@@ -19,7 +19,7 @@ def retrieve_funder_info(doi):
 
 def retrieve_broader_data(funderDoi):
     url=f"http://data.crossref.org/fundingdata/funder/{funderDoi}"
-    response = requests.get(url)
+    response = http_get(url)
     
     funders = []
 
@@ -31,7 +31,7 @@ def retrieve_broader_data(funderDoi):
         if broader_data:
             url = broader_data["resource"]
             #print("Broader Funding Data:", url)
-            response = requests.get(url)
+            response = http_get(url)
         else:
             #print("No further broader data found.")
             break
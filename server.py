@@ -2,20 +2,79 @@ from shiny import render, reactive, ui
 from shinywidgets import output_widget, render_widget
 from query_crossref import *
 from query_clinicaltrials import *
+from query_combined import *
+from crossref_public_data import crossref_public_data_available
+from clinicaltrials_bulk_data import clinicaltrials_bulk_data_available
+from funder_registry_index import funder_registry_index_available
+from input_reader import extract_identifiers
+from http_client import upstream_session, INTERACTIVE_LOOKUP_SIZE, PERMANENT_FAILURE_CATEGORIES
 import matplotlib.pyplot as plt
 
 
+def format_run_report(run_report: dict):
+    """
+    Formats the statistics collected during a query run for display.
+
+    :param run_report: dictionary filled in by query_crossref or query_clinicaltrials
+    :return: text with one line per statistic
+    """
+    lines = []
+    for host, host_latency in run_report.get("latency", {}).items():
+        if host_latency["requests"]:
+            lines.append(f"{host}: {host_latency['requests']} requests, "
+                         f"p50 {host_latency['p50']:.3f}s, p95 {host_latency['p95']:.3f}s, "
+                         f"p99 {host_latency['p99']:.3f}s")
+    if "cache" in run_report:
+        lines.append(f"Result cache: {run_report['cache']['hits']} hits, {run_report['cache']['misses']} misses, "
+                     f"{run_report['cache']['revalidated']} revalidated, "
+                     f"{run_report['cache']['negative_hits']} known failures skipped")
+    if run_report.get("index_hits"):
+        lines.append(f"Answered from the local snapshot index: {run_report['index_hits']}")
+    if run_report.get("retried"):
+        lines.append(f"Transient failures retried at the end of the run: {run_report['retried']}")
+    if "hierarchy_requests_saved" in run_report:
+        lines.append(f"Funder hierarchy requests saved by resolving each funder once: "
+                     f"{run_report['hierarchy_requests_saved']}")
+    if run_report.get("stale"):
+        lines.append(f"Served from last known good data because the upstream failed (stale): "
+                     f"{run_report['stale']}")
+    return "\n".join(lines) if lines else "No requests were sent."
+
+
+def format_failures(failure_dictionary: dict):
+    """
+    Groups identifiers that could not be retrieved by failure category for display.
+
+    :param failure_dictionary: dictionary of identifier to failure category, from a run report
+    :return: text with one line per category, permanent categories first
+    """
+    category_dictionary = {}
+    for identifier, category in failure_dictionary.items():
+        category_dictionary.setdefault(category, []).append(identifier)
+    lines = []
+    for category in sorted(category_dictionary, key=lambda category: (category not in PERMANENT_FAILURE_CATEGORIES,
+                                                                      category)):
+        kind = "permanent" if category in PERMANENT_FAILURE_CATEGORIES else "transient"
+        lines.append(f"{category} ({kind}, {len(category_dictionary[category])}): {category_dictionary[category]}")
+    return "\n".join(lines)
+
+
 def server(input, output, session):
     @reactive.calc
     def app_crossref_read_input_file():
         if (input.crossref_type() == "Text") & (bool(input.crossref_user_file())):
             file = input.crossref_user_file()
             input_list = crossref_read_input_file(file[0]["datapath"])
-            cleaned_input_list = crossref_clean_input_list(input_list)
+            cleaned_input_list = list(crossref_clean_input_list(input_list))
+            return {'clean_input_list': cleaned_input_list}
+        elif (input.crossref_type() == "Bibliographic export") & (bool(input.crossref_user_file())):
+            file = input.crossref_user_file()
+            input_list = crossref_read_export_file(file[0]["datapath"])
+            cleaned_input_list = list(crossref_clean_input_list(input_list))
             return {'clean_input_list': cleaned_input_list}
         elif bool(input.single_doi()):
             input_list = [input.single_doi()]
-            cleaned_input_list = crossref_clean_input_list(input_list)
+            cleaned_input_list = list(crossref_clean_input_list(input_list))
             return {'clean_input_list': cleaned_input_list}
         else:
             return {'clean_input_list': 'Input is missing or invalid.'}
@@ -31,14 +90,19 @@ def server(input, output, session):
         p = ui.Progress()
         p.set(message="Computing, please wait...")
         query_crossref_input = app_crossref_read_input_file()['clean_input_list']
-
-        (identifier_with_error_list,
-         identifier_with_no_funder_list,
-         bottom_level_funder_dictionary,
-         nested_detailed_funder_dictionary,
-         nested_funding_body_type_dictionary,
-         nested_countries_dictionary,
-         nested_grant_dictionary) = query_crossref(query_crossref_input)
+        run_report = {}
+
+        with upstream_session(session.id, interactive=len(query_crossref_input) <= INTERACTIVE_LOOKUP_SIZE):
+            (identifier_with_error_list,
+             identifier_with_no_funder_list,
+             bottom_level_funder_dictionary,
+             nested_detailed_funder_dictionary,
+             nested_funding_body_type_dictionary,
+             nested_countries_dictionary,
+             nested_grant_dictionary) = query_crossref(query_crossref_input, run_report=run_report,
+                                                       hierarchy_source="index" if funder_registry_index_available()
+                                                       else "registry",
+                                                       use_public_data_index=crossref_public_data_available())
         p.close()
 
         return {"identifier_with_error_list": identifier_with_error_list,
@@ -47,23 +111,38 @@ def server(input, output, session):
                 "nested_detailed_funder_dictionary": nested_detailed_funder_dictionary,
                 "nested_funding_body_type_dictionary": nested_funding_body_type_dictionary,
                 "nested_countries_dictionary": nested_countries_dictionary,
-                "nested_grant_dictionary": nested_grant_dictionary}
+                "nested_grant_dictionary": nested_grant_dictionary,
+                "run_report": run_report}
 
     @output
     @render.text
     def app_query_crossref_errors():
         if len(app_query_crossref()['identifier_with_error_list']) != 1:
             return f"{len(app_query_crossref()['identifier_with_error_list'])} DOIs with errors: \n \
-                {app_query_crossref()['identifier_with_error_list']}"
+                {app_query_crossref()['identifier_with_error_list']} \n" \
+                   f"{format_failures(app_query_crossref()['run_report'].get('failures', {}))}"
         else:
             return f"{len(app_query_crossref()['identifier_with_error_list'])} DOI with errors: \n \
-                {app_query_crossref()['identifier_with_error_list']}"
+                {app_query_crossref()['identifier_with_error_list']} \n" \
+                   f"{format_failures(app_query_crossref()['run_report'].get('failures', {}))}"
 
     @output
     @render.text
     def app_query_crossref_no_funders():
         return f"Items with no funder: {app_query_crossref()['identifier_with_no_funder_list']}"
 
+    @output
+    @render.text
+    def app_query_crossref_not_crossref():
+        not_crossref_dictionary = app_query_crossref()['run_report'].get('not_crossref', {})
+        return f"{len(not_crossref_dictionary)} DOIs registered with another agency than Crossref: \n" \
+               f"{not_crossref_dictionary}"
+
+    @output
+    @render.text
+    def app_query_crossref_run_report():
+        return format_run_report(app_query_crossref()['run_report'])
+
     @output
     @render.text
     def app_query_crossref_result():
@@ -196,11 +275,16 @@ def server(input, output, session):
         if (input.clinicaltrials_type() == "Text") & (bool(input.clinicaltrials_user_file())):
             file = input.clinicaltrials_user_file()
             input_list = clinicaltrials_read_input_file(file[0]["datapath"])
-            cleaned_input_list = clinicaltrials_clean_input_list(input_list)
+            cleaned_input_list = list(clinicaltrials_clean_input_list(input_list))
+            return {'clean_input_list': cleaned_input_list}
+        elif (input.clinicaltrials_type() == "Bibliographic export") & (bool(input.clinicaltrials_user_file())):
+            file = input.clinicaltrials_user_file()
+            input_list = clinicaltrials_read_export_file(file[0]["datapath"])
+            cleaned_input_list = list(clinicaltrials_clean_input_list(input_list))
             return {'clean_input_list': cleaned_input_list}
         elif bool(input.single_nctid()):
             input_list = [input.single_nctid()]
-            cleaned_input_list = clinicaltrials_clean_input_list(input_list)
+            cleaned_input_list = list(clinicaltrials_clean_input_list(input_list))
             return {'clean_input_list': cleaned_input_list}
         else:
             return {'clean_input_list': 'Input is missing or invalid.'}
@@ -216,14 +300,18 @@ def server(input, output, session):
         p = ui.Progress()
         p.set(message="Computing, please wait...")
         query_clinicaltrials_input = app_clinicaltrials_read_input_file()['clean_input_list']
-
-        (identifier_with_error_list,
-         identifier_with_no_funder_list,
-         bottom_level_funder_dictionary,
-         lead_sponsor_dictionary,
-         lead_sponsor_class_dictionary,
-         all_collaborators_dictionary,
-         collaborator_class_dictionary) = query_clinicaltrials(query_clinicaltrials_input)
+        run_report = {}
+
+        with upstream_session(session.id, interactive=len(query_clinicaltrials_input) <= INTERACTIVE_LOOKUP_SIZE):
+            (identifier_with_error_list,
+             identifier_with_no_funder_list,
+             bottom_level_funder_dictionary,
+             lead_sponsor_dictionary,
+             lead_sponsor_class_dictionary,
+             all_collaborators_dictionary,
+             collaborator_class_dictionary) \
+                = query_clinicaltrials(query_clinicaltrials_input, run_report=run_report,
+                                       use_bulk_data_index=clinicaltrials_bulk_data_available())
         p.close()
 
         return {"identifier_with_error_list": identifier_with_error_list,
@@ -232,23 +320,31 @@ def server(input, output, session):
                 "lead_sponsor_dictionary": lead_sponsor_dictionary,
                 "lead_sponsor_class_dictionary": lead_sponsor_class_dictionary,
                 "all_collaborators_dictionary": all_collaborators_dictionary,
-                "collaborator_class_dictionary": collaborator_class_dictionary}
+                "collaborator_class_dictionary": collaborator_class_dictionary,
+                "run_report": run_report}
 
     @output
     @render.text
     def app_query_clinicaltrials_errors():
         if len(app_query_clinicaltrials()['identifier_with_error_list']) != 1:
             return f"{len(app_query_clinicaltrials()['identifier_with_error_list'])} NCTIDs with errors: \n \
-                {app_query_clinicaltrials()['identifier_with_error_list']}"
+                {app_query_clinicaltrials()['identifier_with_error_list']} \n" \
+                   f"{format_failures(app_query_clinicaltrials()['run_report'].get('failures', {}))}"
         else:
             return f"{len(app_query_clinicaltrials()['identifier_with_error_list'])} NCTID with errors: \n \
-                {app_query_clinicaltrials()['identifier_with_error_list']}"
+                {app_query_clinicaltrials()['identifier_with_error_list']} \n" \
+                   f"{format_failures(app_query_clinicaltrials()['run_report'].get('failures', {}))}"
 
     @output
     @render.text
     def app_query_clinicaltrials_no_funders():
         return f"Items with no funder: {app_query_clinicaltrials()['identifier_with_no_funder_list']}"
 
+    @output
+    @render.text
+    def app_query_clinicaltrials_run_report():
+        return format_run_report(app_query_clinicaltrials()['run_report'])
+
     @output
     @render.text
     def app_query_clinicaltrials_result():
@@ -308,3 +404,96 @@ def server(input, output, session):
     @render.plot
     def clinicaltrials_sponsor_class_pie():
         return clinicaltrials_sponsor_name_calculations()['fig4']
+
+    @reactive.calc
+    def app_combined_read_input_file():
+        if (input.combined_type() == "Text") & (bool(input.combined_user_file())):
+            file = input.combined_user_file()
+            input_list = crossref_read_input_file(file[0]["datapath"])
+        elif (input.combined_type() == "Bibliographic export") & (bool(input.combined_user_file())):
+            file = input.combined_user_file()
+            input_list = extract_identifiers(file[0]["datapath"])
+        elif bool(input.combined_identifiers()):
+            input_list = input.combined_identifiers().split("\n")
+        else:
+            input_list = []
+        doi_list, nct_list, unrecognized_list = combined_split_input_list(input_list)
+        return {'doi_list': doi_list, 'nct_list': nct_list, 'unrecognized_list': unrecognized_list}
+
+    @output
+    @render.text
+    def app_combined_clean_input_list():
+        return (f"DOIs: {app_combined_read_input_file()['doi_list']} \n"
+                f"NCTIDs: {app_combined_read_input_file()['nct_list']} \n"
+                f"Not recognized: {app_combined_read_input_file()['unrecognized_list']}")
+
+    @reactive.calc
+    @reactive.event(input.query_combined_button, ignore_none=False)
+    def app_query_combined():
+        p = ui.Progress()
+        p.set(message="Computing, please wait...")
+        doi_list = app_combined_read_input_file()['doi_list']
+        nct_list = app_combined_read_input_file()['nct_list']
+        run_report = {}
+
+        with upstream_session(session.id, interactive=len(doi_list) + len(nct_list) <= INTERACTIVE_LOOKUP_SIZE):
+            (crossref_results,
+             clinicaltrials_results,
+             linked_trial_dictionary) = query_combined(doi_list, nct_list, run_report=run_report,
+                                                       hierarchy_source="index" if funder_registry_index_available()
+                                                       else "registry",
+                                                       use_public_data_index=crossref_public_data_available(),
+                                                       use_bulk_data_index=clinicaltrials_bulk_data_available())
+        p.close()
+
+        return {"crossref_identifier_with_error_list": crossref_results[0],
+                "nested_detailed_funder_dictionary": crossref_results[3],
+                "clinicaltrials_identifier_with_error_list": clinicaltrials_results[0],
+                "lead_sponsor_dictionary": clinicaltrials_results[3],
+                "lead_sponsor_class_dictionary": clinicaltrials_results[4],
+                "all_collaborators_dictionary": clinicaltrials_results[5],
+                "linked_trial_dictionary": linked_trial_dictionary,
+                "run_report": run_report}
+
+    @output
+    @render.table(index=False)
+    def combined_linked_table():
+        df = combined_create_linked_table(app_query_combined()['nested_detailed_funder_dictionary'],
+                                          app_query_combined()['lead_sponsor_dictionary'],
+                                          app_query_combined()['lead_sponsor_class_dictionary'],
+                                          app_query_combined()['all_collaborators_dictionary'],
+                                          app_query_combined()['linked_trial_dictionary'])
+        return df.style.set_table_attributes(
+            'class="dataframe shiny-table table w-auto"'
+        ).set_table_styles(
+                    [dict(selector="th", props=[("text-align", "left")])]
+                )
+
+    @output
+    @render.text
+    def app_query_combined_errors():
+        crossref_failures = app_query_combined()['run_report']['crossref'].get('failures', {})
+        clinicaltrials_failures = app_query_combined()['run_report']['clinicaltrials'].get('failures', {})
+        linked_failures = app_query_combined()['run_report']['linked_clinicaltrials'].get('failures', {})
+        return (f"{len(app_query_combined()['crossref_identifier_with_error_list'])} DOIs with errors: \n"
+                f"{format_failures(crossref_failures)} \n"
+                f"{len(app_query_combined()['clinicaltrials_identifier_with_error_list'])} NCTIDs with errors: \n"
+                f"{format_failures({**clinicaltrials_failures, **linked_failures})}")
+
+    @output
+    @render.text
+    def app_query_combined_run_report():
+        return (f"Crossref: \n{format_run_report(app_query_combined()['run_report']['crossref'])} \n"
+                f"ClinicalTrials.gov: \n{format_run_report(app_query_combined()['run_report']['clinicaltrials'])} \n"
+                f"Trials linked from Crossref: \n"
+                f"{format_run_report(app_query_combined()['run_report']['linked_clinicaltrials'])}")
+
+    @output
+    @render.text
+    def app_query_combined_result():
+        return (f"Complete chain of funders: {app_query_combined()['nested_detailed_funder_dictionary']} \n"
+                f"Lead sponsor: {app_query_combined()['lead_sponsor_dictionary']} \n"
+                f"Lead sponsor class: {app_query_combined()['lead_sponsor_class_dictionary']} \n"
+                f"All collaborators: {app_query_combined()['all_collaborators_dictionary']} \n"
+                f"Trials linked from Crossref works: {app_query_combined()['linked_trial_dictionary']} \n"
+                )
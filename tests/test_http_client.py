@@ -0,0 +1,39 @@
+import requests
+
+import http_client
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b"{}"
+
+
+class FakeClient(requests.Session):
+    """
+    Answers 503 for URLs containing "bad" and 200 for all others, counting the requests it gets.
+    """
+    def __init__(self):
+        super().__init__()
+        self.request_count = 0
+
+    def get(self, url, **kwargs):
+        self.request_count += 1
+        return FakeResponse(503 if "bad" in url else 200)
+
+
+def test_failing_identifiers_do_not_open_circuit_for_host(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(http_client, "_client", client)
+    monkeypatch.setattr(http_client, "BACKOFF_BASE", 0.0)
+    host = "breaker-test.example.org"
+
+    for identifier in ("bad1", "bad2"):
+        assert http_client.http_get(f"https://{host}/{identifier}").status_code == 503
+    assert client.request_count == 2 * (http_client.MAX_RETRIES + 1)
+
+    # Each bad identifier counts once, however often it was retried.
+    assert list(http_client.get_circuit_breaker(host).outcomes) == [False, False]
+    assert http_client.http_get(f"https://{host}/good").status_code == 200
+    assert not http_client.get_circuit_breaker(host).is_open()